@@ -1,17 +1,751 @@
 from __future__ import print_function
 from builtins import range
 import numpy as num
-import logging, math
+import logging, math, os, sys, hashlib, pickle
+import multiprocessing
+from contextlib import contextmanager
 
 from pyrocko.gui.snuffling import Snuffling, Param, Switch, NoViewerSet, Choice
 from pyrocko.gui.pile_viewer import Marker, EventMarker, PhaseMarker
 from pyrocko.trace import Trace
-from pyrocko import io, trace, util, cake, orthodrome, model
+from pyrocko import io, util, cake, orthodrome, model, config
 from pyrocko.dataset import crust2x2
+from scipy import sparse
+from scipy.sparse.linalg import lsmr, splu
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger('pyrocko.gui.snufflings.cc_relocation')
 
 km = 1000.
 d2r = math.pi / 180.
 
+# reference to this module, Snuffler removes it from sys.modules after import
+_module = sys.modules[__name__]
+
+
+def model_hash(mod):
+    '''SHA1 hex digest of the ND representation of a cake model.'''
+    return hashlib.sha1(
+        cake.write_nd_model_str(mod).encode('utf-8')).hexdigest()
+
+
+class TravelTimeTable(object):
+    '''
+    First arrivals of a set of cake phases on a distance x depth grid.
+
+    Travel time *t* [s], takeoff angle *takeoff* [deg], ray parameter *p*
+    [s/rad] and slowness at the source *u* [s/m] are tabulated for regularly
+    spaced *distances* [m] and a set of source *depths* [m]. Grid nodes
+    without arrival are NaN. The ray branch of each first arrival is stored
+    in *branch*, numbered separately for each depth, -1 if there is none.
+    '''
+
+    quantities = ('t', 'takeoff', 'p', 'u', 'branch')
+
+    def __init__(self, distances, depths, tables):
+        self.distances = distances
+        self.depths = depths
+        self.tables = tables
+
+    @classmethod
+    def compute(cls, mod, phases, distances, depths):
+        shape = (len(depths), len(distances))
+        tables = dict((k, num.zeros(shape)*num.nan) for k in cls.quantities)
+        tables['branch'] = num.zeros(shape, dtype=int) - 1
+        ddist = distances[1] - distances[0]
+
+        for idepth, depth in enumerate(depths):
+            arrivals = mod.arrivals(
+                    phases=phases,
+                    distances=distances*cake.m2d,
+                    zstart=depth,
+                    zstop=0.0)
+
+            paths = []
+            for arrival in arrivals:
+                idist = int(round(
+                    (arrival.x*cake.d2m - distances[0]) / ddist))
+
+                t = tables['t'][idepth, idist]
+                if num.isfinite(t) and t <= arrival.t:
+                    continue
+
+                ibranch = [path is arrival.path for path in paths]
+                if True in ibranch:
+                    ibranch = ibranch.index(True)
+                else:
+                    ibranch = len(paths)
+                    paths.append(arrival.path)
+
+                tables['t'][idepth, idist] = arrival.t
+                tables['takeoff'][idepth, idist] = arrival.takeoff_angle()
+                tables['p'][idepth, idist] = arrival.p
+                tables['u'][idepth, idist] = \
+                        arrival.path.first_straight().u_in(arrival.endgaps)
+                tables['branch'][idepth, idist] = ibranch
+
+        return cls(distances, depths, tables)
+
+    def dump(self, filename):
+        util.ensuredirs(filename)
+        with open(filename, 'wb') as f:
+            num.savez(f, distances=self.distances, depths=self.depths,
+                    **self.tables)
+
+    @classmethod
+    def load(cls, filename):
+        with num.load(filename) as data:
+            return cls(data['distances'], data['depths'],
+                    dict((k, data[k]) for k in cls.quantities))
+
+    def interpolate(self, distances, depths):
+        '''
+        Interpolate all quantities at *distances* [m] and *depths* [m].
+
+        Arguments are broadcast against each other. Points outside of the
+        grid give NaN.
+
+        Within a ray branch, travel time, ray parameter and slowness at the
+        source are interpolated linearly in distance and the takeoff angle is
+        derived from them. Between nodes of different branches, the branch
+        arriving first is used with the values of its node. Travel times are
+        interpolated linearly in depth, the ray geometry of the nearest depth
+        is used.
+
+        :returns: dict with arrays for ``'t'``, ``'takeoff'``, ``'p'`` and
+            ``'u'``
+        '''
+        distances, depths = num.broadcast_arrays(
+                num.asarray(distances, dtype=float),
+                num.asarray(depths, dtype=float))
+
+        def weights(x, grid):
+            if len(grid) == 1:
+                return num.zeros(x.shape, dtype=int), num.zeros(x.shape), \
+                    x != grid[0]
+
+            ix = num.clip(num.searchsorted(grid, x, side='right') - 1,
+                    0, len(grid)-2)
+            return ix, (x - grid[ix]) / (grid[ix+1] - grid[ix]), \
+                (x < grid[0]) | (x > grid[-1])
+
+        ix, wx, outside_x = weights(distances, self.distances)
+        iz, wz, outside_z = weights(depths, self.depths)
+        iz_next = num.minimum(iz+1, len(self.depths)-1)
+
+        def interpolate_distance(iz):
+            left, right = [
+                dict((k, self.tables[k][iz, i]) for k in self.quantities)
+                for i in (ix, ix+1)]
+
+            # where the branch changes between two nodes, the travel time of
+            # each branch is extrapolated from its node and the earlier
+            # arrival is used with the ray geometry of its node
+            same = (left['branch'] == right['branch']) & (left['branch'] >= 0)
+            t_left = left['t'] + left['p'] / cake.earthradius * \
+                (distances - self.distances[ix])
+            t_right = right['t'] - right['p'] / cake.earthradius * \
+                (self.distances[ix+1] - distances)
+            use_left = num.isnan(t_right) | (t_left <= t_right)
+
+            result = dict(t=num.where(
+                    same,
+                    (1.-wx)*left['t'] + wx*right['t'],
+                    num.where(use_left, t_left, t_right)))
+
+            for k in ('p', 'u'):
+                result[k] = num.where(
+                        same,
+                        (1.-wx)*left[k] + wx*right[k],
+                        num.where(use_left, left[k], right[k]))
+
+            with num.errstate(invalid='ignore'):
+                angle = num.arcsin(num.clip(
+                    result['p'] / (result['u'] *
+                                   cake.radius(self.depths[iz])),
+                    -1., 1.)) / d2r
+
+            result['takeoff'] = num.where(
+                    same,
+                    num.where(left['takeoff'] > 90., 180. - angle, angle),
+                    num.where(use_left, left['takeoff'], right['takeoff']))
+
+            return result
+
+        # travel times are interpolated linearly in depth, the ray geometry
+        # is taken from the nearest depth
+        result = interpolate_distance(iz)
+        if len(self.depths) > 1:
+            result_next = interpolate_distance(iz_next)
+            nearest_next = wz >= 0.5
+            for k in result:
+                if k == 't':
+                    result[k] = (1.-wz)*result[k] + wz*result_next[k]
+                else:
+                    result[k] = num.where(
+                            nearest_next, result_next[k], result[k])
+
+        outside = outside_x | outside_z
+        for k in result:
+            result[k] = num.where(outside, num.nan, result[k])
+
+        return result
+
+
+def get_travel_time_table(mod, phases, distance_max, depths, ddist=1*km,
+        cache_dir=None):
+    '''
+    Get a :py:class:`TravelTimeTable` covering *distance_max* for the source
+    *depths*, loading it from or storing it to *cache_dir*.
+
+    Tables are stored keyed by model hash, phase definitions and grid. The
+    distance extent and spacing are rounded up, so that a table can be
+    reused for similar station configurations.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(config.config().cache_dir, 'cc_relocation')
+
+    # limit table size for large distances
+    ddist = ddist * 2**max(0, math.ceil(math.log(
+            max(distance_max, ddist) / (1000.*ddist), 2)))
+
+    ndist = 50 * int(math.ceil((distance_max / ddist + 2.) / 50.)) + 1
+
+    distances = num.arange(ndist) * ddist
+    depths = num.unique(num.asarray(depths, dtype=float))
+
+    key = hashlib.sha1(('%s %s %g %i %s' % (
+        model_hash(mod),
+        ','.join(phase.definition() for phase in phases),
+        ddist, ndist,
+        ','.join('%g' % depth for depth in depths))).encode(
+            'utf-8')).hexdigest()
+
+    filename = os.path.join(cache_dir, 'tt_%s.npz' % key)
+    if os.path.exists(filename):
+        return TravelTimeTable.load(filename)
+
+    table = TravelTimeTable.compute(mod, phases, distances, depths)
+    table.dump(filename)
+    return table
+
+
+def index_picks(markers):
+    '''
+    Collect picks of all events in one pass over *markers*.
+
+    :returns: dict mapping events to dicts ``{(net, sta, phasename): time}``
+    '''
+    picks = {}
+    for m in markers:
+        if isinstance(m, PhaseMarker) and m.kind == 0:
+            ev = m.get_event()
+            if ev is None:
+                continue
+
+            net, sta, _, _ = m.one_nslc()
+            picks.setdefault(ev, {})[net, sta, m.get_phasename()] = \
+                    (m.tmax + m.tmin) / 2.0
+
+    return picks
+
+
+def get_pick_array(events, stations, phasenames, picks):
+    '''
+    Pick times as array of shape ``(nphases, nstations, nevents)``.
+
+    :param picks: picks as returned by :py:func:`index_picks`
+
+    Missing picks are NaN.
+    '''
+    istations = dict(
+            ((s.network, s.station), i) for (i, s) in enumerate(stations))
+    iphases = dict((name, i) for (i, name) in enumerate(phasenames))
+
+    tpicks = num.zeros((len(phasenames), len(stations), len(events))) * num.nan
+    for iev, ev in enumerate(events):
+        for (net, sta, phasename), t in picks.get(ev, {}).items():
+            istation = istations.get((net, sta), None)
+            iphase = iphases.get(phasename, None)
+            if istation is not None and iphase is not None:
+                tpicks[iphase, istation, iev] = t
+
+    return tpicks
+
+
+def extract_windows(pile, events, stations, phasenames, phases, tmins, tlen,
+        corner_highpass=None, corner_lowpass=None):
+    '''
+    Cut filtered waveform windows of all events, stations and phases.
+
+    For every event and station, the data spanning all phase windows is read
+    once and filtered once, with padding of the longest filter period on
+    both sides. The windows are then cut from the filtered traces.
+
+    :param tmins: window start times, shape ``(nphases, nstations,
+        nevents)``, NaN where no window is wanted
+    :param tlen: window length [s]
+
+    :returns: tuple ``(waveforms, wmins, deltat)``. *waveforms* has shape
+        ``(nevents, nstations, nphases, ncomponents, nsamples)``, with the
+        components of each phase in the order of ``phases[phasename][1]``.
+        *wmins* are the start times of the windows snapped to the sampling,
+        shape ``(nevents, nstations, nphases)``. Missing, incomplete or
+        constant windows are NaN.
+    '''
+    tpad = 0.0
+    for f in corner_highpass, corner_lowpass:
+        if f is not None:
+            tpad = max(tpad, 1.0/f)
+
+    deltat = min(pile.deltats.keys())
+    npad = int(math.ceil(tpad / deltat))
+    nsamples = int(round(tlen / deltat))
+    ncomponents = max(len(phases[name][1]) for name in phasenames)
+
+    nevents, nstations, nphases = len(events), len(stations), len(phasenames)
+    waveforms = num.zeros(
+            (nevents, nstations, nphases, ncomponents, nsamples),
+            dtype=num.float32) * num.nan
+    wmins = num.zeros((nevents, nstations, nphases)) * num.nan
+
+    for iev in range(nevents):
+        for istation, station in enumerate(stations):
+            tmins_sta = tmins[:, istation, iev]
+            iphases = num.nonzero(num.isfinite(tmins_sta))[0]
+            if iphases.size == 0:
+                continue
+
+            ns = station.network, station.station
+            trs = pile.all(
+                    tmin=num.min(tmins_sta[iphases]),
+                    tmax=num.max(tmins_sta[iphases]) + tlen,
+                    tpad=tpad + deltat,
+                    trace_selector=lambda tr: tr.nslc_id[:2] == ns,
+                    want_incomplete=True)
+
+            for tr in trs:
+                if num.all(tr.ydata[0] == tr.ydata):
+                    continue
+
+                if abs(tr.deltat - deltat) > 1e-6 * deltat:
+                    tr.resample(deltat)
+
+                if corner_highpass:
+                    tr.highpass(4, corner_highpass)
+                if corner_lowpass:
+                    tr.lowpass(4, corner_lowpass)
+
+                ydata = tr.get_ydata()
+                for iphase in iphases:
+                    icomp = phases[phasenames[iphase]][1].find(tr.channel[-1])
+                    if icomp < 0:
+                        continue
+
+                    i0 = int(round((tmins_sta[iphase] - tr.tmin) / deltat))
+                    i1 = i0 + nsamples
+                    if i0 - npad < 0 or ydata.size < i1 + npad:
+                        continue
+
+                    window = ydata[i0:i1]
+                    if not num.all(num.isfinite(window)):
+                        continue
+
+                    waveforms[iev, istation, iphase, icomp] = window
+                    wmins[iev, istation, iphase] = tr.tmin + i0 * deltat
+
+    return waveforms, wmins, deltat
+
+
+def get_pairs(ned, distance_max=None, nneighbors=None):
+    '''
+    Select the event pairs to be correlated.
+
+    Without limits all pairs are used. Otherwise a KD-tree on the event
+    coordinates is used to find the pairs not farther apart than
+    *distance_max* and/or the pairs of each event with its *nneighbors*
+    nearest neighbours.
+
+    :param ned: north, east and down coordinates of the events, shape
+        ``(nevents, 3)``
+
+    :returns: indices ``(ia, ib)`` of the event pairs, with ``ia < ib``
+    '''
+    nevents = ned.shape[0]
+    if distance_max is None and nneighbors is None:
+        return num.triu_indices(nevents, k=1)
+
+    tree = cKDTree(ned)
+    if nneighbors is None:
+        pairs = num.array(sorted(tree.query_pairs(distance_max)), dtype=int)
+        if pairs.size == 0:
+            return num.zeros(0, dtype=int), num.zeros(0, dtype=int)
+
+        return pairs[:,0], pairs[:,1]
+
+    k = min(int(nneighbors) + 1, nevents)
+    dists, ineighbors = tree.query(
+            ned, k=k,
+            distance_upper_bound=num.inf if distance_max is None
+            else distance_max)
+
+    ineighbors = ineighbors.reshape((nevents, k))
+    ievents = num.repeat(num.arange(nevents), k).reshape((nevents, k))
+    ok = (ineighbors < nevents) & (ineighbors != ievents)
+    ia = num.minimum(ievents[ok], ineighbors[ok])
+    ib = num.maximum(ievents[ok], ineighbors[ok])
+    ipairs = num.unique(ia * nevents + ib)
+
+    return ipairs // nevents, ipairs % nevents
+
+
+def correlate_pairs(windows, wmins, deltat, ia, ib, want_cc=False,
+        nmax_block=2**23):
+    '''
+    Cross correlate the windows of event pairs in the frequency domain.
+
+    Each window is normalized and Fourier transformed once. The correlations
+    of all pairs are then computed in blocks from the spectra and averaged
+    over the components available for both events of a pair. As with
+    :py:func:`pyrocko.trace.correlate` and chopping to the central half of
+    the lags, the time shift of the maximum is that of event *ib* relative
+    to event *ia*, including the difference of the window start times.
+
+    :param windows: windows of one phase at one station, shape
+        ``(nevents, ncomponents, nsamples)``, NaN where missing
+    :param wmins: window start times, shape ``(nevents,)``
+    :param ia,ib: event indices of the pairs
+    :param want_cc: additionally return the averaged correlations at the
+        central lags, shape ``(npairs, nlags)``
+    :param nmax_block: maximum number of correlation samples per block
+
+    :returns: tuple ``(coefs, tshifts)`` of shape ``(npairs,)``, NaN for
+        pairs without common component
+    '''
+    nevents, ncomponents, nsamples = windows.shape
+    valid = num.isfinite(windows[:,:,0])
+    data = num.where(valid[:,:,num.newaxis], windows, 0.).astype(float)
+    norms = num.sqrt(num.sum(data**2, axis=2))
+    data /= num.where(norms > 0., norms, 1.)[:,:,num.newaxis]
+
+    nfft = 2**int(math.ceil(math.log(2*nsamples - 1, 2)))
+    spectra = num.fft.rfft(data, nfft, axis=2)
+
+    # central half of the lags of the full correlation
+    lags = num.arange(
+            int(round((nsamples-1)*0.5)),
+            int(round((nsamples-1)*1.5))) - (nsamples-1)
+
+    ncommon = num.sum(valid[ia] & valid[ib], axis=1)
+    coefs = num.zeros(ia.size) * num.nan
+    tshifts = num.zeros(ia.size) * num.nan
+    if want_cc:
+        ccs = num.zeros((ia.size, lags.size)) * num.nan
+
+    nblock = max(1, nmax_block // (ncomponents*nfft))
+    for iblock in range(0, ia.size, nblock):
+        block = slice(iblock, iblock+nblock)
+        cc = num.fft.irfft(
+                num.conj(spectra[ia[block]]) * spectra[ib[block]],
+                nfft, axis=2)
+
+        cc = num.sum(cc, axis=1)[:, lags % nfft]
+        cc /= num.maximum(ncommon[block], 1)[:,num.newaxis]
+
+        imax = num.argmax(cc, axis=1)
+        coefs[block] = cc[num.arange(imax.size), imax]
+        tshifts[block] = wmins[ib[block]] - wmins[ia[block]] + \
+                lags[imax] * deltat
+
+        if want_cc:
+            ccs[block] = cc
+
+    missing = ncommon == 0
+    coefs[missing] = num.nan
+    tshifts[missing] = num.nan
+
+    if want_cc:
+        return coefs, tshifts, ccs
+
+    return coefs, tshifts
+
+
+@contextmanager
+def worker_pool(nworkers, func):
+    '''
+    Pool of *nworkers* processes able to run *func* of this module.
+
+    The module and its directory are put back into :py:data:`sys.modules`
+    and :py:data:`sys.path` for the lifetime of the pool, because Snuffler
+    removes them after loading the snuffling and *func* could not be pickled
+    otherwise. Yields ``None`` for a single worker or if *func* still cannot
+    be pickled, then the caller processes serially.
+    '''
+    if nworkers <= 1:
+        yield None
+        return
+
+    name = _module.__name__
+    dirname = os.path.dirname(os.path.abspath(_module.__file__))
+    add_module = name not in sys.modules
+    add_path = dirname not in sys.path
+    if add_module:
+        sys.modules[name] = _module
+
+    if add_path:
+        sys.path.append(dirname)
+
+    pool = None
+    try:
+        try:
+            pickle.dumps(func)
+            if hasattr(multiprocessing, 'get_context') and \
+                    'fork' in multiprocessing.get_all_start_methods():
+                pool = multiprocessing.get_context('fork').Pool(nworkers)
+            else:
+                pool = multiprocessing.Pool(nworkers)
+
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            logger.warning('correlating serially: %s' % e)
+
+        yield pool
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+        if add_path:
+            sys.path.remove(dirname)
+
+        if add_module:
+            del sys.modules[name]
+
+
+def event_id(event):
+    '''Identifier of an event in the correlation cache.'''
+    return '%s_%s' % (event.name, util.time_to_str(event.time))
+
+
+def window_id(event, tmin):
+    '''
+    Identifier of the window of an event starting at *tmin* in the
+    correlation cache.
+    '''
+    return '%s_%.6f' % (event_id(event), tmin)
+
+
+class CorrelationCache(object):
+    '''
+    On-disk cache of the correlation results of event pairs.
+
+    The coefficients and time shifts of one station and phase are stored in
+    an NPZ file for each combination of filter and window parameters, earth
+    model and master event, keyed by the ids of the two event windows of a
+    pair (see :py:func:`window_id`). Windows moved by changed picks or time
+    corrections thus get correlated again. Pairs which could not be
+    correlated are not stored, so that they are retried in later runs.
+    '''
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                    config.config().cache_dir, 'cc_relocation', 'correlations')
+
+        self.cache_dir = cache_dir
+
+    def filename(self, station, phasename, params):
+        key = hashlib.sha1(repr(
+                (station.network, station.station, station.location,
+                 phasename) + tuple(params)).encode('utf-8')).hexdigest()
+
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def load(self, station, phasename, params):
+        '''
+        :returns: dict mapping pairs of event ids to tuples ``(coef,
+            tshift)``
+        '''
+        filename = self.filename(station, phasename, params)
+        if not os.path.exists(filename):
+            return {}
+
+        with num.load(filename) as data:
+            return dict(zip(
+                    zip(data['ids_a'].tolist(), data['ids_b'].tolist()),
+                    zip(data['coefs'].tolist(), data['tshifts'].tolist())))
+
+    def dump(self, station, phasename, params, results):
+        filename = self.filename(station, phasename, params)
+        keys = list(results.keys())
+        values = num.array(
+                [results[k] for k in keys], dtype=float).reshape((-1, 2))
+        util.ensuredirs(filename)
+        with open(filename, 'wb') as f:
+            num.savez(f,
+                    ids_a=num.array([k[0] for k in keys], dtype=str),
+                    ids_b=num.array([k[1] for k in keys], dtype=str),
+                    coefs=values[:,0], tshifts=values[:,1])
+
+
+def get_ray_geometry(mod, phases, phasenames, master, master_depth, stations,
+        cache_dir=None):
+    '''
+    First arrival travel times and ray geometry from *master* to *stations*.
+
+    :returns: tuple ``(tt, g)`` with travel times of shape
+        ``(nphases, nstations)`` and the north, east and down components of
+        the slowness vectors at the source, shape ``(nphases, nstations, 3)``.
+        Missing arrivals are NaN.
+    '''
+    lats = num.array([s.lat for s in stations], dtype=float)
+    lons = num.array([s.lon for s in stations], dtype=float)
+    dists = orthodrome.distance_accurate50m_numpy(
+            master.lat, master.lon, lats, lons)
+    azis = orthodrome.azimuth_numpy(master.lat, master.lon, lats, lons) * d2r
+
+    tt = num.zeros((len(phasenames), len(stations))) * num.nan
+    g = num.zeros((len(phasenames), len(stations), 3)) * num.nan
+    for iphase, phasename in enumerate(phasenames):
+        table = get_travel_time_table(
+                mod, phases[phasename][0], num.max(dists), [master_depth],
+                cache_dir=cache_dir)
+
+        arrivals = table.interpolate(dists, master_depth)
+        takeoff = arrivals['takeoff'] * d2r
+        u = arrivals['u']
+
+        tt[iphase] = arrivals['t']
+        g[iphase] = num.array([
+                num.cos(azis) * num.sin(takeoff) * u,
+                num.sin(azis) * num.sin(takeoff) * u,
+                num.cos(takeoff) * u ]).T
+
+    return tt, g
+
+
+def build_system(g, coefs, tshifts, ia, ib, nevents, min_corr=0.0,
+        weighting='linear', fix_depth=False):
+    '''
+    Assemble the sparse double-difference system of the event pairs.
+
+    Each correlation with a coefficient of at least *min_corr* gives a row
+    relating the differential time shift of the pair to the differences of
+    the north, east, down and time corrections of the two events. The rows
+    are weighted by the correlation coefficient (*weighting* ``'linear'``),
+    its square (``'quadratic'``) or not at all (``'equal'``). Four
+    unweighted rows constrain the mean corrections to zero and with
+    *fix_depth* one row per event fixes its depth.
+
+    :param g: slowness vectors, shape ``(nphases, nstations, 3)``
+    :param coefs,tshifts: correlation results of the pairs, shape
+        ``(nphases, nstations, npairs)``
+    :param ia,ib: event indices of the pairs
+
+    :returns: tuple ``(a, d, w)`` with the CSR matrix of the system, the
+        weighted data vector and the weights of the correlation rows.
+        The unknowns are ordered ``(north, east, down, time)`` per event.
+    '''
+    iphase, istation, ipair = num.nonzero(
+            num.isfinite(tshifts) & num.isfinite(coefs)
+            & (num.where(num.isfinite(coefs), coefs, -1.) >= min_corr))
+
+    w = coefs[iphase, istation, ipair]
+    if weighting == 'equal':
+        w = num.ones_like(w)
+    elif weighting == 'quadratic':
+        w = w**2
+
+    nsamp = w.size
+    ga = g[iphase, istation]
+    ones = num.ones((nsamp, 1))
+    values = num.hstack((ga, -ones, -ga, ones)) * w[:,num.newaxis]
+    cols = num.hstack((
+            ia[ipair][:,num.newaxis]*4 + num.arange(4),
+            ib[ipair][:,num.newaxis]*4 + num.arange(4)))
+    rows = num.repeat(num.arange(nsamp), 8)
+    values = values.ravel()
+    cols = cols.ravel()
+
+    # zero mean of the corrections
+    nconstraints = 4
+    rows = num.concatenate((rows, nsamp + num.repeat(num.arange(4), nevents)))
+    cols = num.concatenate(
+            (cols, (num.arange(4)[:,num.newaxis] + num.arange(nevents)*4).ravel()))
+    values = num.concatenate((values, num.ones(4*nevents)))
+
+    if fix_depth:
+        rows = num.concatenate(
+                (rows, nsamp + nconstraints + num.arange(nevents)))
+        cols = num.concatenate((cols, num.arange(nevents)*4 + 2))
+        values = num.concatenate((values, num.ones(nevents)))
+        nconstraints += nevents
+
+    a = sparse.coo_matrix(
+            (values, (rows, cols)),
+            shape=(nsamp + nconstraints, nevents*4)).tocsr()
+
+    d = num.zeros(nsamp + nconstraints)
+    d[:nsamp] = tshifts[iphase, istation, ipair] * w
+
+    return a, d, w
+
+
+def solve_system(a, d, damp=0.0, atol=1e-10, btol=1e-10):
+    '''
+    Solve the sparse least-squares system with LSMR.
+
+    The columns are scaled to unit norm before solving, so that the
+    damping is relative to the column norms and does not depend on the
+    units of the unknowns.
+    '''
+    norms = num.sqrt(num.asarray(a.multiply(a).sum(axis=0))).ravel()
+    norms[norms == 0.0] = 1.0
+    scaling = sparse.diags(1.0/norms)
+    y = lsmr(a.dot(scaling), d, damp=damp, atol=atol, btol=btol,
+             maxiter=10*a.shape[1])[0]
+
+    return y / norms
+
+
+def factorize_system(a, damp=0.0, regularization=1e-10):
+    '''
+    Factorize the normal equations of the sparse system once.
+
+    The columns are scaled as in :py:func:`solve_system` and the sparse LU
+    factorization of the damped normal equations is computed. A tiny
+    *regularization*, relative to the unit column norms, keeps the
+    factorization stable for unknowns which are not constrained by any
+    correlation. Its bias is removed by iterative refinement.
+
+    :returns: function solving the system for a data vector or for many
+        data vectors at once, given as columns of a 2D array
+    '''
+    norms = num.sqrt(num.asarray(a.multiply(a).sum(axis=0))).ravel()
+    norms[norms == 0.0] = 1.0
+    a_scaled = a.dot(sparse.diags(1.0/norms)).tocsr()
+
+    n = a_scaled.T.dot(a_scaled) + sparse.identity(a.shape[1]) * damp**2
+    lu = splu(sparse.csc_matrix(
+        n + sparse.identity(a.shape[1]) * regularization))
+
+    def solve(d, nrefine=2):
+        b = num.asarray(a_scaled.T.dot(d))
+        y = lu.solve(b)
+        # remove the bias of the regularization
+        for i in range(nrefine):
+            y += lu.solve(b - n.dot(y))
+
+        if y.ndim == 2:
+            return y / norms[:,num.newaxis]
+        else:
+            return y / norms
+
+    return solve
+
+
+class RelocationError(Exception):
+    pass
+
 
 class CorrelateEvents(Snuffling):
 
@@ -32,13 +766,22 @@ class CorrelateEvents(Snuffling):
         self.add_parameter(Param('Replace master depth [km]', 'master_depth_km', None,
             0.0, 100., high_is_none=True))
 
-        self.add_parameter(Switch('Save figure', 'save', False))
+        self.add_parameter(Switch('Save results', 'save', False))
         self.add_parameter(Switch('Fix depth', 'fix_depth', False))
         self.add_parameter(Switch('Show correlation traces', 'show_correlation_traces', False))
         self.add_parameter(Choice('Weighting', 'weighting', 'cubic',
             ['equal', 'linear', 'quadratic']))
         self.add_parameter(Choice('Earth model', 'model_select', 'Global',
             ['Global (ak135)', 'Local (from crust2x2)']))
+        self.add_parameter(Param('Maximum pair distance [km]',
+            'pair_distance_max_km', None, 0.1, 100., high_is_none=True))
+        self.add_parameter(Param('Nearest neighbours', 'nneighbors', None,
+            1, 100, high_is_none=True))
+        self.add_parameter(Param('Damping', 'damping', 0.0, 0.0, 0.001))
+        self.add_parameter(Param('Bootstrap realizations', 'nrealizations',
+            100, 10, 1000))
+        self.add_parameter(Param('Worker processes', 'nworkers', 1, 1, 64))
+        self.add_parameter(Switch('Cache correlations', 'use_cache', True))
 
         self.set_live_update(False)
         self.model = None
@@ -56,10 +799,6 @@ class CorrelateEvents(Snuffling):
             self.fail('no master event selected')
 
         stations = list(viewer.stations.values())
-        stations.sort(key=lambda s: (s.network,s.station))
-
-        if not stations:
-            self.fail('no station information available')
 
         # gather events to be processed
 
@@ -69,12 +808,62 @@ class CorrelateEvents(Snuffling):
                 if m.kind == 0:
                     events.append( m.get_event() )
 
-        events.sort(key=lambda ev: ev.time)
+        try:
+            result = self.relocate(master, events, stations, viewer.markers)
+        except RelocationError as e:
+            self.fail(str(e))
 
-        event_to_number = {}
-        for iev, ev in enumerate(events):
-            event_to_number[ev] = iev
+        self.add_markers(result['markers'])
+        if result['traces']:
+            self.add_traces(result['traces'])
+
+        for line in result['stats']:
+            print(line)
+
+        # plot event correlation matrix
+
+        fframe = self.figure_frame()
+        fig = fframe.gcf()
+        self.plot_correlations(fig, result)
+
+        if self.save:
+            fig.savefig(self.output_filename(dir='correlation.pdf'))
+
+        fig.canvas.draw()
+
+        self.add_markers([
+                EventMarker(event, kind=4) for event in result['events']])
+
+        if self.save:
+            model.Event.dump_catalog(result['events'], self.output_filename(
+                    caption='Save relocated events',
+                    dir='events.relocated.txt'))
+
+        # plot results
+
+        fframe = self.figure_frame()
+        fig = fframe.gcf()
+        self.plot_locations(fig, result)
+
+        if self.save:
+            fig.savefig(self.output_filename(dir='locations.pdf'))
+
+        fig.canvas.draw()
+
+    def set_progress(self, label, value):
+        '''
+        Show progress in the viewer, if there is one.
+
+        :returns: ``True`` if the user requested to abort
+        '''
+        try:
+            viewer = self.get_viewer()
+        except NoViewerSet:
+            return False
+
+        return viewer.parent().get_progressbars().set_status(label, value)
 
+    def get_model(self, master):
         if self.model_select.startswith('Global'):
             model_key = 'global'
         else:
@@ -92,6 +881,45 @@ class CorrelateEvents(Snuffling):
 
             self.model_key = model_key
 
+        return self.model
+
+    def relocate(self, master, events, stations, markers):
+        '''
+        Relocate *events* relative to *master* by waveform cross correlation.
+
+        Travel times, window extraction, correlation, inversion and bootstrap
+        are run with the current parameters of the snuffling. Waveforms are
+        taken from :py:meth:`get_pile`, picks from the phase markers in
+        *markers*. This does not need a viewer.
+
+        :returns: dict with the relocated ``'events'``, the sorted input
+            events ``'events_in'``, ``'stats'`` lines, window ``'markers'``,
+            correlation ``'traces'``, the mean correlation matrices
+            ``'coefssum'``, the relative locations ``'ned'`` and their
+            bootstrap realizations ``'ned_bootstrap'`` and the centered
+            catalog locations ``'ned_orig'`` in [m]
+        '''
+        stations = sorted(stations, key=lambda s: (s.network,s.station))
+
+        if not stations:
+            raise RelocationError('no station information available')
+
+        events = list(events)
+        if not events:
+            raise RelocationError('no events to be processed')
+
+        stats = []
+        window_markers = []
+        traces = []
+
+        events.sort(key=lambda ev: ev.time)
+
+        event_to_number = {}
+        for iev, ev in enumerate(events):
+            event_to_number[ev] = iev
+
+        mod = self.get_model(master)
+
         phases = {
                 'P': ([ cake.PhaseDef(x) for x in 'P p'.split() ], 'Z'),
                 'S': ([ cake.PhaseDef(x) for x in 'S s'.split() ], 'NE'),
@@ -105,67 +933,20 @@ class CorrelateEvents(Snuffling):
         if self.master_depth_km is not None:
             master_depth = self.master_depth_km * km
 
-        tt = {}
-        g = {}
-        for iphase, phasename in enumerate(phasenames):
-            for istation, station in enumerate(stations):
-                dist = orthodrome.distance_accurate50m(master, station)
-                azi = orthodrome.azimuth(master, station)
-
-                arrivals = self.model.arrivals(
-                        phases=phases[phasename][0],
-                        distances=[ dist*cake.m2d ],
-                        zstart = master_depth,
-                        zstop = 0.0)
-
-                if arrivals:
-                    first = arrivals[0]
-                    tt[station.network, station.station, phasename] = first.t
-
-                    takeoff = first.takeoff_angle()
-                    u = first.path.first_straight().u_in(first.endgaps)
-
-                    g[iphase, istation] = num.array([
-                            math.cos(azi*d2r) * math.sin(takeoff*d2r) * u,
-                            math.sin(azi*d2r) * math.sin(takeoff*d2r) * u,
-                            math.cos(takeoff*d2r) * u ])
+        tt_table, g = get_ray_geometry(
+                mod, phases, phasenames, master, master_depth, stations)
 
         # gather picks for each event
 
-        for ev in events:
-            picks = {}
-            for m2 in viewer.markers:
-                if isinstance(m2, PhaseMarker) and m2.kind == 0:
-                    if m2.get_event() == ev:
-                        net, sta, _, _ = m2.one_nslc()
-                        picks[net,sta,m2.get_phasename()] = (m2.tmax + m2.tmin) / 2.0
-
-            ev.picks = picks
+        picks = index_picks(markers)
+        tpicks = get_pick_array(events, stations, phasenames, picks)
 
         # time corrections for extraction windows
 
-        dataobs = []
-        datasyn = []
-        for phasename in phasenames:
-            for station in stations:
-                nsp = station.network, station.station, phasename
-                datasyn.append(tt.get(nsp,None))
-                for ev in events:
-                    if nsp in ev.picks:
-                        ttobs = ev.picks[nsp] - ev.time
-                    else:
-                        ttobs = None
-
-                    dataobs.append(ttobs)
-
-        ttsyn = num.array(datasyn, dtype=num.float).reshape((
-            len(phasenames),
-            len(stations)))
+        tevents_raw = num.array( [ ev.time for ev in events ] )
 
-        ttobs = num.array(dataobs, dtype=num.float).reshape((
-            len(phasenames),
-            len(stations),
-            len(events)))
+        ttobs = tpicks - tevents_raw[num.newaxis,num.newaxis,:]
+        ttsyn = tt_table
 
         ttres = ttobs - ttsyn[:,:,num.newaxis]
         tt_corr_event = num.nansum( ttres, axis=1) /  \
@@ -181,107 +962,55 @@ class CorrelateEvents(Snuffling):
 
         ttres -= tt_corr_station[:,:, num.newaxis]
 
-        tevents_raw = num.array( [ ev.time for ev in events ] )
-
         tevents_corr = tevents_raw + num.mean(tt_corr_event, axis=0)
 
-        # print timing information
-
-        print('timing stats')
-
-        for iphasename, phasename in enumerate(phasenames):
-            data = []
-            for ev in events:
-                iev = event_to_number[ev]
-                for istation, station in enumerate(stations):
-                    nsp = station.network, station.station, phasename
-                    if nsp in tt and nsp in ev.picks:
-                        tarr = ev.time + tt[nsp]
-                        tarr_ec = tarr + tt_corr_event[iphasename, iev]
-                        tarr_ec_sc = tarr_ec + tt_corr_station[iphasename, istation]
-                        tobs = ev.picks[nsp]
+        # synthetic and corrected arrivals, shape = (nphases, nstations, nevents)
 
-                        data.append((tobs-tarr, tobs-tarr_ec, tobs-tarr_ec_sc))
+        tarr = tevents_raw[num.newaxis,num.newaxis,:] + ttsyn[:,:,num.newaxis]
+        tarr_ec = tarr + tt_corr_event[:,num.newaxis,:]
+        tarr_ec_sc = tarr_ec + tt_corr_station[:,:,num.newaxis]
 
-            if data:
+        # print timing information
 
-                data = num.array(data, dtype=num.float).T
+        stats.append('timing stats')
 
-                print('event %10s %3s %3i %15.2g %15.2g %15.2g' % (
-                        (ev.name, phasename, data.shape[1]) +
+        for iphasename, phasename in enumerate(phasenames):
+            tobs = tpicks[iphasename]
+            have = num.isfinite(tobs) & num.isfinite(tarr[iphasename])
+            if num.any(have):
+                data = [ tobs[have] - x[iphasename][have]
+                         for x in (tarr, tarr_ec, tarr_ec_sc) ]
+
+                stats.append('event %10s %3s %3i %15.2g %15.2g %15.2g' % (
+                        (events[-1].name, phasename, data[0].size) +
                             tuple( num.mean(num.abs(x)) for x in data )))
             else:
-                print('event %10s %3s no picks' % (ev.name, phasename))
+                stats.append(
+                    'event %10s %3s no picks' % (events[-1].name, phasename))
 
         # extract and preprocess waveforms
 
-        tpad = 0.0
-        for f in self.corner_highpass, self.corner_lowpass:
-            if f is not None:
-                tpad = max(tpad, 1.0/f)
-
-        pile = self.get_pile()
-        waveforms = {}
-        for ev in events:
-            iev = event_to_number[ev]
-            markers = []
-            for iphasename, phasename in enumerate(phasenames):
-                for istation, station in enumerate(stations):
-                    nsp = station.network, station.station, phasename
-                    if nsp in tt:
-                        tarr = ev.time + tt[nsp]
-                        nslcs = [ ( station.network, station.station, '*', '*' ) ]
-                        marker = PhaseMarker( nslcs, tarr, tarr, 1, event=ev,
-                                phasename=phasename)
-                        markers.append(marker)
-
-                        tarr2 = tarr + tt_corr_station[iphasename, istation] + \
-                                tt_corr_event[iphasename, iev]
-
-                        marker = PhaseMarker( nslcs, tarr2, tarr2, 2, event=ev,
-                                phasename=phasename)
-
-                        markers.append(marker)
+        tmins = tarr_ec_sc + self.tstart
+        tmaxs = tarr_ec_sc + self.tend
 
-                        tmin = tarr2+self.tstart
-                        tmax = tarr2+self.tend
-
-                        marker = PhaseMarker( nslcs,
-                                tmin, tmax, 3, event=ev,
-                                phasename=phasename)
-
-                        markers.append(marker)
-
-                        trs = pile.all(tmin, tmax, tpad=tpad, trace_selector=
-                                lambda tr: tr.nslc_id[:2] == nsp[:2],
-                                want_incomplete=False)
-
-                        trok = []
-                        for tr in trs:
-                            if num.all(tr.ydata[0] == tr.ydata):
-                                continue
-
-                            if self.corner_highpass:
-                                tr.highpass(4, self.corner_highpass)
-                            if self.corner_lowpass:
-                                tr.lowpass(4, self.corner_lowpass)
-
-                            tr.chop(tmin, tmax)
-                            tr.set_location(ev.name)
-                            #tr.shift( - (tmin - master.time) )
-
-                            if num.all(num.isfinite(tr.ydata)):
-                                trok.append(tr)
-
-                        waveforms[nsp+(iev,)] = trok
-
-            self.add_markers(markers)
-
-        def get_channel(trs, cha):
-            for tr in trs:
-                if tr.channel == cha:
-                    return tr
-            return None
+        for iev, ev in enumerate(events):
+            markers_ev = []
+            for iphasename, istation in zip(
+                    *num.nonzero(num.isfinite(ttsyn))):
+
+                phasename = phasenames[iphasename]
+                station = stations[istation]
+                k = iphasename, istation, iev
+                nslcs = [ ( station.network, station.station, '*', '*' ) ]
+                markers_ev.extend([
+                    PhaseMarker( nslcs, tarr[k], tarr[k], 1, event=ev,
+                        phasename=phasename),
+                    PhaseMarker( nslcs, tarr_ec_sc[k], tarr_ec_sc[k], 2,
+                        event=ev, phasename=phasename),
+                    PhaseMarker( nslcs, tmins[k], tmaxs[k], 3,
+                        event=ev, phasename=phasename) ])
+
+            window_markers.extend(markers_ev)
 
         nevents = len(events)
         nstations = len(stations)
@@ -289,201 +1018,207 @@ class CorrelateEvents(Snuffling):
 
         # correlate waveforms
 
-        coefs = num.zeros((nphases, nstations, nevents, nevents))
-        coefs.fill(num.nan)
+        ned = num.zeros((nevents, 3))
+        ned[:,0], ned[:,1] = orthodrome.latlon_to_ne_numpy(
+                master.lat, master.lon,
+                num.array([ev.lat for ev in events]),
+                num.array([ev.lon for ev in events]))
+        ned[:,2] = [ev.depth for ev in events]
+
+        ia, ib = get_pairs(
+                ned,
+                distance_max=None if self.pair_distance_max_km is None
+                else self.pair_distance_max_km * km,
+                nneighbors=self.nneighbors)
+        coefs = num.zeros((nphases, nstations, ia.size)) * num.nan
         tshifts = coefs.copy()
-        tshifts_picked = coefs.copy()
-        for iphase, phasename in enumerate(phasenames):
-            for istation, station in enumerate(stations):
-                nsp = station.network, station.station, phasename
-
-                for a in events:
-                    ia = event_to_number[a]
-                    for b in events:
-                        ib = event_to_number[b]
 
-                        if ia == ib:
-                            continue
+        # look up correlations of previous runs
 
-                        if nsp in a.picks and nsp in b.picks:
-                            tshifts_picked[iphase,istation,ia,ib] = \
-                                    b.picks[nsp] - a.picks[nsp]
-
-                        wa = waveforms[nsp+(ia,)]
-                        wb = waveforms[nsp+(ib,)]
+        pile = self.get_pile()
+        cache_params = (self.corner_highpass, self.corner_lowpass,
+                        self.tstart, self.tend, min(pile.deltats.keys()),
+                        model_hash(mod), event_id(master), master_depth)
+
+        cache = None
+        cached = {}
+        pair_ids = {}
+        missing = num.ones(coefs.shape, dtype=bool)
+        if self.use_cache and not self.show_correlation_traces:
+            cache = CorrelationCache()
+            for iphase, phasename in enumerate(phasenames):
+                for istation, station in enumerate(stations):
+                    ids = [window_id(ev, tmins[iphase,istation,iev])
+                           for (iev, ev) in enumerate(events)]
+                    pair_ids[iphase,istation] = [
+                        (ids[ia[ipair]], ids[ib[ipair]])
+                        for ipair in range(ia.size)]
+
+                    results = cache.load(station, phasename, cache_params)
+                    for ipair, key in enumerate(pair_ids[iphase,istation]):
+                        if key in results:
+                            coefs[iphase,istation,ipair], \
+                                tshifts[iphase,istation,ipair] = results[key]
+                            missing[iphase,istation,ipair] = False
+
+                    cached[iphase,istation] = results
+
+        # extract windows of the events of the missing pairs
+
+        have_pair = num.any(missing, axis=(0,1))
+        ievents = num.unique(num.concatenate(
+                (ia[have_pair], ib[have_pair])))
+
+        iwindows = num.zeros(nevents, dtype=int)
+        iwindows[ievents] = num.arange(ievents.size)
+
+        if ievents.size != 0:
+            waveforms, wmins, deltat = extract_windows(
+                    pile, [events[iev] for iev in ievents], stations,
+                    phasenames, phases, tmins[:,:,ievents],
+                    self.tend - self.tstart,
+                    corner_highpass=self.corner_highpass,
+                    corner_lowpass=self.corner_lowpass)
+
+        stats.append('%i event pairs, %i correlations from cache' % (
+                ia.size, num.sum(~missing)))
+
+        blocks = [(iphase, istation)
+                  for iphase in range(nphases)
+                  for istation in range(nstations)
+                  if num.any(missing[iphase,istation])]
+
+        def block_args(iphase, istation):
+            ipairs = num.nonzero(missing[iphase,istation])[0]
+            return (waveforms[:,istation,iphase], wmins[:,istation,iphase],
+                    deltat, iwindows[ia[ipairs]], iwindows[ib[ipairs]],
+                    self.show_correlation_traces)
+
+        nworkers = min(int(self.nworkers or 1), len(blocks))
+
+        label = 'Correlating %i event pairs' % ia.size
+        with worker_pool(nworkers, correlate_pairs) as pool:
+            try:
+                if pool is not None:
+                    jobs = [pool.apply_async(correlate_pairs,
+                                             block_args(*block))
+                            for block in blocks]
+
+                for iblock, (iphase, istation) in enumerate(blocks):
+                    if self.set_progress(label, iblock*100./len(blocks)):
+                        raise RelocationError('Correlation aborted')
+
+                    if pool is not None:
+                        result = jobs[iblock].get()
+                    else:
+                        result = correlate_pairs(
+                                *block_args(iphase, istation))
 
-                        channels = list(set([ tr.channel for tr in wa + wb ]))
-                        channels.sort()
+                    ipairs = num.nonzero(missing[iphase,istation])[0]
+                    coefs[iphase,istation,ipairs] = result[0]
+                    tshifts[iphase,istation,ipairs] = result[1]
 
-                        tccs = []
-                        for cha in channels:
-                            if cha[-1] not in phases[phasename][1]:
+                    if cache is not None:
+                        results = cached[iphase,istation]
+                        for ipair in ipairs:
+                            if not num.isfinite(coefs[iphase,istation,ipair]):
                                 continue
 
-                            ta = get_channel(wa, cha)
-                            tb = get_channel(wb, cha)
-                            if ta is None or tb is None:
-                                continue
-
-                            tcc = trace.correlate(ta,tb, mode='full', normalization='normal',
-                                    use_fft=True)
-
-                            tccs.append(tcc)
-
-                        if not tccs:
-                            continue
-
-                        tc = None
-                        for tcc in tccs:
-                            if tc is None:
-                                tc = tcc
-                            else:
-                                tc.add(tcc)
-
-                        tc.ydata *= 1./len(tccs)
-
-                        tmid = tc.tmin*0.5 + tc.tmax*0.5
-                        tlen = (tc.tmax - tc.tmin)*0.5
-                        tc_cut = tc.chop(tmid-tlen*0.5, tmid+tlen*0.5, inplace=False)
-
-                        tshift, coef = tc_cut.max()
-
-                        if (tshift < tc.tmin + 0.5*tc.deltat or
-                                tc.tmax - 0.5*tc.deltat < tshift):
-                            continue
-
-                        coefs[iphase,istation,ia,ib] = coef
-                        tshifts[iphase,istation,ia,ib] = tshift
-
-                        if self.show_correlation_traces:
-                            tc.shift(master.time - (tc.tmax + tc.tmin)/2.)
-                            self.add_trace(tc)
-
-
-        #tshifts = tshifts_picked
-
-        coefssum_sta = num.nansum(coefs, axis=2) / num.sum(num.isfinite(coefs), axis=2)
+                            results[pair_ids[iphase,istation][ipair]] = \
+                                coefs[iphase,istation,ipair], \
+                                tshifts[iphase,istation,ipair]
+
+                        cache.dump(stations[istation], phasenames[iphase],
+                                   cache_params, results)
+
+                    if self.show_correlation_traces:
+                        station = stations[istation]
+                        for ipair in num.nonzero(num.isfinite(result[0]))[0]:
+                            cc = result[2][ipair]
+                            traces.append(Trace(
+                                    station.network, station.station,
+                                    '%s~%s' % (events[ia[ipair]].name,
+                                               events[ib[ipair]].name),
+                                    phasenames[iphase],
+                                    tmin=master.time - (cc.size-1)*0.5*deltat,
+                                    deltat=deltat, ydata=cc))
+
+            finally:
+                self.set_progress(label, 100)
+
+        # mean coefficients per station and per event pair, coefficients of
+        # the pair (ia, ib) are used for (ib, ia) as well
+
+        valid = num.isfinite(coefs)
+        coefs0 = num.where(valid, coefs, 0.)
+        coefssum_sta = num.zeros((nphases, nstations, nevents))
+        nsum_sta = num.zeros((nphases, nstations, nevents))
+        for i in ia, ib:
+            num.add.at(coefssum_sta, (slice(None), slice(None), i), coefs0)
+            num.add.at(nsum_sta, (slice(None), slice(None), i), valid)
+
+        coefssum_sta /= nsum_sta
         csum_sta = num.nansum(coefssum_sta, axis=2) / num.sum(num.isfinite(coefssum_sta), axis=2)
 
         for iphase, phasename in enumerate(phasenames):
             for istation, station in enumerate(stations):
-                print('station %-5s %s %15.2g' %
+                stats.append('station %-5s %s %15.2g' %
                       (station.station, phasename, csum_sta[iphase,istation]))
 
-        coefssum = num.nansum(coefs, axis=1) / num.sum(num.isfinite(coefs), axis=1)
+        coefssum = num.zeros((nphases, nevents, nevents)) * num.nan
+        coefssum[:,ia,ib] = num.nansum(coefs, axis=1) / num.sum(valid, axis=1)
+        coefssum[:,ib,ia] = coefssum[:,ia,ib]
         csumevent = num.nansum(coefssum, axis=2) / num.sum(num.isfinite(coefssum), axis=2)
-        above = num.where(num.isfinite(coefs), coefs >= self.min_corr, 0)
 
-        csumabove = num.sum(num.sum(above, axis=1), axis=2)
+        above = num.sum(num.where(valid, coefs >= self.min_corr, 0), axis=1)
+        csumabove = num.zeros((nphases, nevents), dtype=int)
+        for i in ia, ib:
+            num.add.at(csumabove, (slice(None), i), above)
 
         coefssum = num.ma.masked_invalid(coefssum)
 
-        print('correlation stats')
+        stats.append('correlation stats')
 
         for iphase, phasename in enumerate(phasenames):
             for ievent, event in enumerate(events):
-                print('event %10s %3s %8i %15.2g' % (
+                stats.append('event %10s %3s %8i %15.2g' % (
                         event.name, phasename,
                         csumabove[iphase,ievent], csumevent[iphase,ievent]))
 
-        # plot event correlation matrix
-
-        fframe = self.figure_frame()
-        fig = fframe.gcf()
-
-        for iphase, phasename in enumerate(phasenames):
-
-            p = fig.add_subplot(1,nphases,iphase+1)
-            p.set_xlabel('Event number')
-            p.set_ylabel('Event number')
-            mesh = p.pcolormesh(coefssum[iphase])
-            cb = fig.colorbar(mesh, ax=p)
-            cb.set_label('Max correlation coefficient')
-
-        if self.save:
-            fig.savefig(self.output_filename(dir='correlation.pdf'))
+        # setup and solve linear system
 
-        fig.canvas.draw()
+        a, d, w = build_system(
+                g, coefs, tshifts, ia, ib, nevents,
+                min_corr=self.min_corr, weighting=self.weighting,
+                fix_depth=self.fix_depth)
 
+        nsamp = w.size
+        if nsamp == 0:
+            raise RelocationError(
+                    'No correlations above minimum correlation')
 
-        # setup and solve linear system
+        x = solve_system(a, d, damp=self.damping)
 
-        data = []
-        rows = []
-        weights = []
-        for iphase in range(nphases):
-            for istation in range(nstations):
-                for ia in range(nevents):
-                    for ib in range(ia+1,nevents):
-                        k = iphase, istation, ia, ib
-                        w = coefs[k]
-                        if not num.isfinite(tshifts[k]) \
-                                or not num.isfinite(w) or w < self.min_corr:
-                            continue
-
-                        row = num.zeros(nevents*4)
-                        row[ia*4:ia*4+3] = g[iphase,istation]
-                        row[ia*4+3] = -1.0
-                        row[ib*4:ib*4+3] = -g[iphase,istation]
-                        row[ib*4+3] = 1.0
-                        weights.append(w)
-
-                        rows.append(row)
-                        data.append(tshifts[iphase,istation,ia,ib])
-
-        nsamp = len(data)
-
-        for i in range(4):
-            row = num.zeros(nevents*4)
-            row[i::4] = 1.
-            rows.append(row)
-            data.append(0.0)
-
-        if self.fix_depth:
-            for ievent in range(nevents):
-                row = num.zeros(nevents*4)
-                row[ievent*4+2] = 1.0
-                rows.append(row)
-                data.append(0.0)
-
-        a = num.array(rows, dtype=num.float)
-        d = num.array(data, dtype=num.float)
-        w = num.array(weights, dtype=num.float)
-
-        if self.weighting == 'equal':
-            w[:nsamp] = 1.0
-        elif self.weighting == 'linear':
-            pass
-        elif self.weighting == 'quadratic':
-            w[:nsamp] = w[:nsamp]**2
-
-        a[:nsamp,:] *= w[:,num.newaxis]
-        d[:nsamp] *= w[:nsamp]
-
-        x, residuals, rank, singular = num.linalg.lstsq(a,d)
+        def mean_abs_residual(x, d):
+            return num.mean(num.abs((a[:nsamp].dot(x) - d[:nsamp])/w))
 
         x0 = num.zeros(nevents*4)
         x0[3::4] = tevents_corr
-        mean_abs_residual0 = num.mean(
-                num.abs((num.dot(a[:nsamp], x0) - d[:nsamp])/w[:nsamp]))
-
-        mean_abs_residual = num.mean(
-                num.abs((num.dot(a[:nsamp],x) - d[:nsamp])/w[:nsamp]))
+        mean_abs_residual0 = mean_abs_residual(x0, d)
+        noiseamount = mean_abs_residual(x, d)
 
-        print(mean_abs_residual0, mean_abs_residual)
+        stats.append('mean absolute residual %15.2g %15.2g' % (
+                mean_abs_residual0, noiseamount))
 
         # distorted solutions
 
-        npermutations = 100
-        noiseamount = mean_abs_residual
-        xdistorteds = []
-        for i in range(npermutations):
-            dnoisy = d.copy()
-            dnoisy[:nsamp] += num.random.normal(size=nsamp)*noiseamount*w[:nsamp]
-            xdistorted, residuals, rank, singular = num.linalg.lstsq(a,dnoisy)
-            xdistorteds.append(xdistorted)
+        nrealizations = int(self.nrealizations)
+        noise = num.zeros((d.size, nrealizations))
+        noise[:nsamp] = num.random.normal(size=(nsamp, nrealizations)) \
+            * noiseamount * w[:,num.newaxis]
 
-            mean_abs_residual = num.mean(num.abs(num.dot(a,xdistorted)[:nsamp] - dnoisy[:nsamp]))
+        solve = factorize_system(a, damp=self.damping)
+        xdistorteds = solve(d[:,num.newaxis] + noise)
 
         tmean = num.mean([ e.time for e in events ])
 
@@ -492,13 +1227,6 @@ class CorrelateEvents(Snuffling):
         down = x[2::4]
         etime = x[3::4] + tmean
 
-        def plot_range(x):
-            mi, ma = num.percentile(x, [10., 90.])
-            ext = (ma-mi)/5.
-            mi -= ext
-            ma += ext
-            return mi, ma
-
         lat, lon = orthodrome.ne_to_latlon(master.lat, master.lon, north, east)
 
         events_out = []
@@ -509,14 +1237,8 @@ class CorrelateEvents(Snuffling):
                     depth=down[ievent] + master_depth,
                     name = event.name)
 
-            mark = EventMarker(event_out, kind=4)
-            self.add_marker(mark)
             events_out.append(event_out)
 
-        model.Event.dump_catalog(events_out, 'events.relocated.txt')
-
-        # plot results
-
         ned_orig = []
         for event in events:
             n, e = orthodrome.latlon_to_ne(master, event)
@@ -530,12 +1252,43 @@ class CorrelateEvents(Snuffling):
         ned_orig[:,1] -= num.mean(ned_orig[:,1])
         ned_orig[:,2] -= num.mean(ned_orig[:,2])
 
-        north0, east0, down0 = ned_orig.T
+        return dict(
+                events=events_out,
+                events_in=events,
+                stats=stats,
+                markers=window_markers,
+                traces=traces,
+                phasenames=phasenames,
+                coefssum=coefssum,
+                ned=num.array([north, east, down]).T,
+                ned_bootstrap=xdistorteds.T.reshape((-1,4))[:,:3],
+                ned_orig=ned_orig)
+
+    def plot_correlations(self, fig, result):
+        '''Plot the mean correlation matrices of a relocation.'''
+        phasenames = result['phasenames']
+        for iphase, phasename in enumerate(phasenames):
+
+            p = fig.add_subplot(1,len(phasenames),iphase+1)
+            p.set_xlabel('Event number')
+            p.set_ylabel('Event number')
+            mesh = p.pcolormesh(result['coefssum'][iphase])
+            cb = fig.colorbar(mesh, ax=p)
+            cb.set_label('Max correlation coefficient')
 
-        north2, east2, down2, time2 = num.hstack(xdistorteds).reshape((-1,4)).T
+    def plot_locations(self, fig, result):
+        '''Plot relative locations and bootstrap clouds of a relocation.'''
+        events = result['events_in']
+        north, east, down = result['ned'].T
+        north0, east0, down0 = result['ned_orig'].T
+        north2, east2, down2 = result['ned_bootstrap'].T
 
-        fframe = self.figure_frame()
-        fig = fframe.gcf()
+        def plot_range(x):
+            mi, ma = num.percentile(x, [10., 90.])
+            ext = (ma-mi)/5.
+            mi -= ext
+            ma += ext
+            return mi, ma
 
         color_sym = (0.1,0.1,0.0)
         color_scat = (0.3,0.5,1.0,0.2)
@@ -592,12 +1345,142 @@ class CorrelateEvents(Snuffling):
             p1.set_xlim(mi_down/km, ma_down/km)
             p2.set_ylim(mi_down/km, ma_down/km)
 
-        if self.save:
-            fig.savefig(self.output_filename(dir='locations.pdf'))
-
-        fig.canvas.draw()
+    def configure_cli_parser(self, parser):
+        parser.add_option(
+            '--stations',
+            dest='stations_filename',
+            metavar='FILENAME',
+            help='Read stations from FILENAME')
+
+        parser.add_option(
+            '--events',
+            dest='events_filename',
+            metavar='FILENAME',
+            help='Read events from catalog FILENAME (default: event markers '
+                 'in the markers file)')
+
+        parser.add_option(
+            '--markers',
+            dest='markers_filename',
+            metavar='FILENAME',
+            help='Read picks from FILENAME')
+
+        parser.add_option(
+            '--master',
+            dest='master_name',
+            metavar='NAME',
+            help='Name of the master event (default: first event)')
+
+        parser.add_option(
+            '--weighting',
+            dest='weighting',
+            default='linear',
+            choices=('equal', 'linear', 'quadratic'),
+            help="weighting of the correlations [default: '%default']")
+
+        parser.add_option(
+            '--local-model',
+            dest='local_model',
+            action='store_true',
+            default=False,
+            help='use crust2x2 model at the master instead of ak135')
+
+        parser.add_option(
+            '--fix-depth',
+            dest='fix_depth',
+            action='store_true',
+            default=False,
+            help='fix event depths')
+
+        parser.add_option(
+            '--no-cache',
+            dest='use_cache',
+            action='store_false',
+            default=True,
+            help='do not cache correlations')
+
+        parser.add_option(
+            '--output',
+            dest='out_filename',
+            default='events.relocated.txt',
+            metavar='FILENAME',
+            help='Write relocated events to FILENAME [default: %default]')
+
+        parser.add_option(
+            '--stats',
+            dest='stats_filename',
+            metavar='FILENAME',
+            help='Write correlation statistics to FILENAME (default: stdout)')
 
 
 def __snufflings__():
     return [CorrelateEvents()]
 
+
+if __name__ == '__main__':
+    import sys
+    from pyrocko.gui.marker import associate_phases_to_events
+
+    logger = logging.getLogger()
+    util.setup_logging('cc_relocation.py', 'info')
+    s = CorrelateEvents()
+    options, args, parser = s.setup_cli()
+
+    for opt in ('stations_filename', 'markers_filename'):
+        if not getattr(options, opt):
+            logger.critical('no %s file given; use the --%s=FILENAME option' % (
+                opt.split('_')[0], opt.split('_')[0]))
+            sys.exit(1)
+
+    for opt in ('weighting', 'fix_depth', 'use_cache'):
+        setattr(s, opt, getattr(options, opt))
+
+    if options.local_model:
+        s.model_select = 'Local (from crust2x2)'
+
+    markers = Marker.load_markers(options.markers_filename)
+    if options.events_filename:
+        events = list(model.Event.load_catalog(options.events_filename))
+        markers.extend(EventMarker(event) for event in events)
+    else:
+        events = [m.get_event() for m in markers
+                  if isinstance(m, EventMarker) and m.kind == 0]
+
+    associate_phases_to_events(markers)
+
+    if not events:
+        logger.critical('no events given')
+        sys.exit(1)
+
+    if options.master_name:
+        masters = [ev for ev in events if ev.name == options.master_name]
+        if not masters:
+            logger.critical('no event named %s' % options.master_name)
+            sys.exit(1)
+
+        master = masters[0]
+    else:
+        master = min(events, key=lambda ev: ev.time)
+        logger.info('using %s as master event' % master.name)
+
+    try:
+        result = s.relocate(
+            master, events, model.load_stations(options.stations_filename),
+            markers)
+
+    except RelocationError as e:
+        logger.critical(str(e))
+        sys.exit(1)
+
+    util.ensuredirs(options.out_filename)
+    model.Event.dump_catalog(result['events'], options.out_filename)
+
+    if options.stats_filename:
+        util.ensuredirs(options.stats_filename)
+        with open(options.stats_filename, 'w') as f:
+            for line in result['stats']:
+                f.write(line + '\n')
+    else:
+        for line in result['stats']:
+            print(line)
+
@@ -3,24 +3,42 @@ from builtins import zip
 from builtins import range
 
 import numpy as num
+import os
+import sys
 import time
+import pickle
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from fractions import Fraction
 from matplotlib.animation import FuncAnimation
 
 from pyrocko.gui.snuffling import Param, Snuffling, Choice, Switch
-from scipy.signal import fftconvolve, lfilter, hilbert
+from pyrocko.gui.pile_viewer import PhaseMarker, EventMarker
+from scipy.signal import fftconvolve, sosfilt, sosfilt_zi, butter, hilbert
+from scipy.signal import firwin, resample_poly, lfilter, lfilter_zi
 from scipy.interpolate import UnivariateSpline
 from pyrocko import orthodrome as ortho
 from pyrocko import parstack
 from pyrocko import util
 from pyrocko import trace
 from pyrocko import model
+from pyrocko import pile as pile_mod
 import logging
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 
 logger = logging.getLogger('pyrocko.gui.snufflings.fk_parstack.py')
 d2r = num.pi/180.
 km = 1000.
 
+# Snuffler drops this module from sys.modules after loading it
+_module = sys.modules[__name__]
+
 
 def search_max_block(n_maxsearch, data):
     '''
@@ -41,7 +59,7 @@ def search_max_block(n_maxsearch, data):
         a = data
 
     return num.argmax(a.reshape((-1, n_maxsearch)), axis=1) +\
-        num.arange(0, (n+n_missing)/n_maxsearch) * n_maxsearch
+        num.arange(0, (n+n_missing)//n_maxsearch) * n_maxsearch
 
 
 def instantaneous_phase(signal):
@@ -54,6 +72,21 @@ def get_instantaneous_frequency(signal, fs):
     return (num.diff(inst_phase) / (2.0*num.pi) * fs)
 
 
+def phase_weighted_stack(aligned, power=2.):
+    '''
+    Phase weighted stack of the time aligned rows of *aligned*.
+
+    The linear stack is weighted by the coherence of the instantaneous phases
+    of all rows, raised to *power*. Instantaneous phases are computed with a
+    single Hilbert transform along the time axis of the 2-D array.
+    '''
+    analytic = hilbert(aligned, axis=1)
+    amplitudes = num.abs(analytic)
+    phasors = analytic / num.where(amplitudes > 0., amplitudes, 1.)
+    coherence = num.abs(num.mean(phasors, axis=0))**power
+    return num.sum(aligned, axis=0) * coherence
+
+
 def get_center_station(stations, select_closest=False):
     ''' gravitations center of *stations* list.'''
     n = len(stations)
@@ -82,75 +115,828 @@ def get_theoretical_backazimuth(event, stations, center_station):
             + 180.) % 360.
 
 
-def get_shifts(stations, center_station, bazis, slownesses):
-    ''' shape = (len(bazi), len(slow))'''
-    lats = num.array([s.lat for s in stations])
-    lons = num.array([s.lon for s in stations])
-    lat0 = num.array([center_station.lat] * len(stations))
-    lon0 = num.array([center_station.lon] * len(stations))
+def get_station_vectors(stations, center_station):
+    ''' north/east offsets of *stations* relative to *center_station*,
+    shape = (len(stations), 2)'''
+    lats = num.array([s.lat for s in stations], dtype=num.float64)
+    lons = num.array([s.lon for s in stations], dtype=num.float64)
+    lat0 = num.repeat(center_station.lat, len(stations))
+    lon0 = num.repeat(center_station.lon, len(stations))
     ns, es = ortho.latlon_to_ne_numpy(lat0, lon0, lats, lons)
-    station_vector = num.array((ns, es)).T
-    bazis = bazis * d2r
-    shifts = num.zeros((len(bazis)*len(slownesses), len(stations)))
-    ishift = 0
-    for ibazi, bazi in enumerate(bazis):
-        s_vector = num.array((num.cos(bazi), num.sin(bazi)))
-        for islowness, slowness in enumerate(slownesses):
-            shifts[ishift] = station_vector.dot(s_vector) * slowness
-            ishift += 1
+    return num.array((ns, es)).T
+
+
+def get_shifts(stations, center_station, bazis, slownesses):
+    ''' shape = (len(bazi)*len(slow), len(stations))
+
+    Back-azimuth varies slowest along the first axis, slowness fastest.
+    '''
+    station_vector = get_station_vectors(stations, center_station)
+    bazis = num.asarray(bazis, dtype=num.float64) * d2r
+    slownesses = num.asarray(slownesses, dtype=num.float64)
+    s_vectors = num.array((num.cos(bazis), num.sin(bazis)))
+
+    # projection of station offsets onto propagation directions,
+    # shape = (n_bazis, n_stations)
+    projections = s_vectors.T.dot(station_vector.T)
+    shifts = projections[:, num.newaxis, :] * \
+        slownesses[num.newaxis, :, num.newaxis]
+
+    return shifts.reshape((-1, len(stations)))
+
+
+class ShiftTableCache(object):
+    '''
+    LRU cache of shift tables.
+
+    Tables are keyed by station coordinates, center station, back-azimuth and
+    slowness grid and sampling interval, so that consecutive processing
+    windows with an unchanged station set reuse the same table. Returned
+    arrays are shared between calls and must not be modified in place.
+    '''
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+
+    @staticmethod
+    def make_key(stations, center_station, bazis, slownesses, deltat):
+        coords = num.array(
+            [(s.lat, s.lon) for s in stations], dtype=num.float64)
+        return (
+            coords.tobytes(),
+            float(center_station.lat), float(center_station.lon),
+            num.asarray(bazis, dtype=num.float64).tobytes(),
+            num.asarray(slownesses, dtype=num.float64).tobytes(),
+            float(deltat))
+
+    def get(self, stations, center_station, bazis, slownesses, deltat):
+        '''
+        Get shift table in seconds and shifts rounded to samples of *deltat*.
+
+        :returns: tuple ``(shift_table, shifts)``, both of shape
+            ``(len(bazis)*len(slownesses), len(stations))``
+        '''
+        key = self.make_key(
+            stations, center_station, bazis, slownesses, deltat)
+
+        try:
+            tables = self._tables.pop(key)
+        except KeyError:
+            shift_table = get_shifts(
+                stations=stations,
+                center_station=center_station,
+                bazis=bazis,
+                slownesses=slownesses)
+
+            shifts = num.round(shift_table / deltat).astype(num.int32)
+            tables = (shift_table, shifts)
+
+            while len(self._tables) >= self.maxsize:
+                self._tables.popitem(last=False)
+
+        self._tables[key] = tables
+        return tables
 
-    return shifts
+    def clear(self):
+        self._tables.clear()
+
+
+def fk_window_spectra(arrays, deltat, nwindow, fmin=None, fmax=None):
+    '''
+    Band limited spectra of the sliding windows of *arrays* as used by
+    :py:func:`fk_frequency_domain`.
+
+    :param arrays: 2-D array of shape ``(ntraces, nsamples)``
+    :param deltat: sampling interval of *arrays*
+    :param nwindow: length of the sliding analysis window in samples
+    :param fmin,fmax: frequency band. Defaults to the full band.
+
+    :returns: dict with the spectra ``'spectra'`` of the Hanning tapered
+        windows (half-window overlap), shape ``(nfreqs, ntraces, nwin)``,
+        their frequencies ``'freqs'``, the total power of each window
+        ``'total_power'`` and the window length and step in samples,
+        ``'nwindow'`` and ``'nstep'``
+    '''
+    data = num.asarray(arrays, dtype=num.float64)
+    ntraces, nsamples = data.shape
+
+    nwindow = int(max(2, min(nwindow, nsamples)))
+    nstep = max(1, nwindow // 2)
+    nwin = (nsamples - nwindow) // nstep + 1
+
+    iwindows = num.arange(nwin)[:, num.newaxis] * nstep + \
+        num.arange(nwindow)[num.newaxis, :]
+
+    segments = data[:, iwindows] * num.hanning(nwindow)
+    spectra = num.fft.rfft(segments, axis=-1)
+    freqs = num.fft.rfftfreq(nwindow, deltat)
+
+    band = freqs > 0.
+    if fmin is not None:
+        band &= freqs >= fmin
+    if fmax is not None:
+        band &= freqs <= fmax
+
+    if not num.any(band):
+        raise ValueError('no frequencies in band %s - %s Hz' % (fmin, fmax))
+
+    spectra = spectra[:, :, band].transpose((2, 0, 1))
+    return dict(
+        spectra=spectra,
+        freqs=freqs[band],
+        total_power=num.sum(num.abs(spectra)**2, axis=(0, 1)) * ntraces,
+        nwindow=nwindow,
+        nstep=nstep)
+
+
+def fk_frequency_domain(arrays, shift_table, deltat, nwindow, lengthout,
+                        offsetout=0, fmin=None, fmax=None, nmax_chunk=2**22,
+                        window_spectra=None):
+    '''
+    Frequency domain f-k power over the full grid of *shift_table*.
+
+    :param arrays: 2-D array of shape ``(ntraces, nsamples)``
+    :param shift_table: time shifts in seconds, shape
+        ``(ngridpoints, ntraces)``
+    :param deltat: sampling interval of *arrays*
+    :param nwindow: length of the sliding analysis window in samples
+    :param lengthout: number of output samples
+    :param offsetout: index in *arrays* of the first output sample
+    :param fmin,fmax: frequency band evaluated. Defaults to the full band.
+    :param nmax_chunk: maximum number of complex elements of intermediate
+        arrays. The grid is processed in chunks accordingly.
+    :param window_spectra: spectra of *arrays* as returned by
+        :py:func:`fk_window_spectra`, to avoid recomputing them when the
+        grid is evaluated in several calls. *arrays*, *nwindow*, *fmin* and
+        *fmax* are ignored if given.
+
+    The cross-spectral matrix of each Hanning tapered window (half-window
+    overlap) is projected onto the steering vectors of all grid points and
+    summed over the frequency band. As the cross-spectral matrix of a single
+    snapshot is the outer product of the spectra, the quadratic form is
+    evaluated as the squared magnitude of batched matrix products of steering
+    vectors and spectra. Power is relative to the total power in the band,
+    i.e. it is 1 for a perfectly coherent plane wave.
+
+    Returns *frames* of shape ``(ngridpoints, lengthout)`` compatible to the
+    output of :py:func:`pyrocko.parstack.parstack`. Each output sample holds
+    the power of the window centered closest to it.
+    '''
+    if window_spectra is None:
+        window_spectra = fk_window_spectra(
+            arrays, deltat, nwindow, fmin=fmin, fmax=fmax)
+
+    spectra = window_spectra['spectra']
+    freqs = window_spectra['freqs']
+    total_power = window_spectra['total_power']
+    nwindow = window_spectra['nwindow']
+    nstep = window_spectra['nstep']
+
+    nfreqs, ntraces, nwin = spectra.shape
+    ngridpoints = shift_table.shape[0]
+
+    power = num.zeros((ngridpoints, nwin))
+    nchunk = max(1, int(nmax_chunk // (nfreqs * max(ntraces, nwin))))
+    for igrid in range(0, ngridpoints, nchunk):
+        chunk = slice(igrid, igrid+nchunk)
+        steering = num.exp(
+            (-2.j*num.pi) * freqs[:, num.newaxis, num.newaxis]
+            * shift_table[num.newaxis, chunk, :])
+
+        beams = num.matmul(steering, spectra)
+        power[chunk] = num.sum(beams.real**2 + beams.imag**2, axis=0)
+
+    power /= num.where(total_power > 0., total_power, 1.)
+
+    icenters = num.arange(lengthout) + offsetout - nwindow // 2
+    iwin = num.clip(
+        num.round(icenters / float(nstep)), 0, nwin-1).astype(num.int64)
+
+    return power[:, iwin]
 
 
 def to_db(d):
     return 10*num.log10(d/num.max(d))
 
 
+def get_arf_frequencies(deltat, fmin=None, fmax=None, nfrequencies=16):
+    '''
+    Frequencies at which the array response is evaluated. Defaults to the
+    band from 1/100 to 1/4 of the sampling rate if corners are not given.
+    '''
+    fmin = fmin or 0.01 / deltat
+    fmax = min(fmax or 0.25 / deltat, 0.5 / deltat)
+    return num.linspace(fmin, max(fmin, fmax), nfrequencies)
+
+
+def array_response(shift_table, frequencies, nmax_chunk=2**22):
+    '''
+    Array response function (ARF) of a grid of delays.
+
+    The ARF is the power of the beam of a vertically incident plane wave
+    steered towards each grid point, averaged over *frequencies*.
+
+    :param shift_table: delays [s] of shape ``(ngridpoints, nstations)``
+    :param frequencies: frequencies [Hz]
+    :param nmax_chunk: maximum number of phase terms evaluated at once
+
+    :returns: ARF normalized to 1 for zero delays, shape ``(ngridpoints,)``
+    '''
+    ngrid, nstations = shift_table.shape
+    omegas = 2. * num.pi * num.asarray(frequencies, dtype=num.float64)
+    nchunk = max(1, nmax_chunk // (omegas.size * nstations))
+
+    arf = num.empty(ngrid)
+    for igrid in range(0, ngrid, nchunk):
+        chunk = slice(igrid, igrid+nchunk)
+
+        # shape = (nchunk, nfrequencies, nstations)
+        phases = shift_table[chunk, num.newaxis, :] * \
+            omegas[num.newaxis, :, num.newaxis]
+
+        power = num.sum(num.cos(phases), axis=2)**2 + \
+            num.sum(num.sin(phases), axis=2)**2
+
+        arf[chunk] = num.mean(power, axis=1)
+
+    arf /= nstations**2
+    return arf
+
+
+class ArrayResponseCache(object):
+    '''
+    LRU cache of array response functions.
+
+    Responses are keyed like :py:class:`ShiftTableCache` by station geometry
+    and grid, and additionally by the evaluated frequencies, so that they are
+    only recomputed if the station set or the grid changes.
+    '''
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._responses = OrderedDict()
+
+    def get(self, stations, center_station, bazis, slownesses, frequencies):
+        '''
+        Get the ARF on the back-azimuth/slowness grid.
+
+        :returns: array of shape ``(len(bazis), len(slownesses))``
+        '''
+        key = ShiftTableCache.make_key(
+            stations, center_station, bazis, slownesses, 0.) + (
+                num.asarray(frequencies, dtype=num.float64).tobytes(),)
+
+        try:
+            arf = self._responses.pop(key)
+        except KeyError:
+            shift_table = get_shifts(
+                stations, center_station, bazis, slownesses)
+
+            arf = array_response(shift_table, frequencies).reshape(
+                (len(bazis), len(slownesses)))
+
+            while len(self._responses) >= self.maxsize:
+                self._responses.popitem(last=False)
+
+        self._responses[key] = arf
+        return arf
+
+    def clear(self):
+        self._responses.clear()
+
+
+_sos_cache = {}
+
+
+def get_cached_sos(order, corner, deltat, btype):
+    '''
+    Butterworth filter coefficients as second-order sections.
+
+    Coefficients are cached by *order*, *corner*, *deltat* and *btype*.
+    '''
+    key = (order, corner, deltat, btype)
+    if key not in _sos_cache:
+        _sos_cache[key] = butter(
+            order, corner*2.0*deltat, btype=btype, output='sos')
+
+    return _sos_cache[key]
+
+
+def get_filter_sos(deltat, highpass=None, lowpass=None, order=4):
+    '''
+    Cascade of highpass and lowpass as second-order sections or ``None``.
+    '''
+    sos = []
+    if highpass:
+        sos.append(get_cached_sos(order, highpass, deltat, 'high'))
+    if lowpass:
+        sos.append(get_cached_sos(order, lowpass, deltat, 'low'))
+
+    if not sos:
+        return None
+
+    return num.vstack(sos)
+
+
 def lowpass_array(ydata_array, deltat, order, corner, demean=True, axis=1):
     '''
-    Apply butterworth highpass to the trace.
+    Apply butterworth lowpass to the rows of *ydata_array*.
 
     :param order: order of the filter
     :param corner: corner frequency of the filter
 
     Mean is removed before filtering.
     '''
-
-    (b, a) = trace._get_cached_filter_coefs(
-        order, [corner*2.0*deltat], btype='low')
-    data = ydata_array.astype(num.float64)
-    if len(a) != order+1 or len(b) != order+1:
-        logger.warn(
-            'Erroneous filter coefficients returned by '
-            'scipy.signal.butter(). You may need to downsample the '
-            'signal before filtering.')
+    data = num.array(ydata_array, dtype=num.float64)
     if demean:
-        data -= num.mean(data, axis=1)[None].T
+        data -= num.mean(data, axis=axis, keepdims=True)
 
-    return lfilter(b, a, data)
+    return sosfilt(get_cached_sos(order, corner, deltat, 'low'), data,
+                   axis=axis)
 
 
 def highpass_array(ydata_array, deltat, order, corner, demean=True, axis=1):
     '''
-    Apply butterworth highpass to the trace.
+    Apply butterworth highpass to the rows of *ydata_array*.
 
     :param order: order of the filter
     :param corner: corner frequency of the filter
 
     Mean is removed before filtering.
     '''
-    (b, a) = trace._get_cached_filter_coefs(
-        order, [corner*2.0*deltat], btype='high')
-    data = ydata_array.astype(num.float64)
-    if len(a) != order+1 or len(b) != order+1:
-        logger.warn(
-            'Erroneous filter coefficients returned by '
-            'scipy.signal.butter(). You may need to downsample the '
-            'signal before filtering.')
+    data = num.array(ydata_array, dtype=num.float64)
     if demean:
-        data -= num.mean(data, axis=1)[None].T
+        data -= num.mean(data, axis=axis, keepdims=True)
+
+    return sosfilt(get_cached_sos(order, corner, deltat, 'high'), data,
+                   axis=axis)
+
+
+def preprocess_arrays(ydata_array, deltat, highpass=None, lowpass=None,
+                      order=4, taper=None):
+    '''
+    Demean, filter and smooth all rows of a 2-D data array at once.
+
+    :param ydata_array: data of shape ``(ntraces, nsamples)``
+    :param highpass,lowpass: corner frequencies of butterworth filters of
+        given *order* or ``None``
+    :param taper: smoothing window convolved with each row or ``None``
+
+    Highpass and lowpass are applied as a single cascade of second-order
+    sections.
+
+    :returns: preprocessed float64 array of same shape as *ydata_array*
+    '''
+    data = num.array(ydata_array, dtype=num.float64)
+    data -= num.mean(data, axis=1, keepdims=True)
+
+    sos = get_filter_sos(deltat, highpass, lowpass, order=order)
+    if sos is not None:
+        data = sosfilt(sos, data, axis=1)
+
+    if taper is not None:
+        data = fftconvolve(
+            data, taper[num.newaxis, :], mode='same', axes=1)
+
+    return data
+
+
+_resample_filter_cache = {}
+
+
+def get_resample_ratio(deltat, deltat_target, max_denominator=1000):
+    '''
+    Get integer factors ``(up, down)`` to resample from *deltat* to
+    *deltat_target*.
+    '''
+    ratio = Fraction(deltat_target / deltat).limit_denominator(
+        max_denominator)
+    return ratio.denominator, ratio.numerator
+
+
+def get_cached_resample_filter(up, down):
+    '''
+    Get the FIR anti-aliasing filter used by
+    :py:func:`scipy.signal.resample_poly` for *up* and *down*.
+    '''
+    key = (up, down)
+    if key not in _resample_filter_cache:
+        max_rate = max(up, down)
+        _resample_filter_cache[key] = firwin(
+            2*10*max_rate + 1, 1./max_rate, window=('kaiser', 5.0))
+
+    return _resample_filter_cache[key]
+
+
+def get_resample_tpad(deltats, deltat_target):
+    '''
+    Time span at the edges of a resampled trace affected by the zero padding
+    of the resampling filter, rounded up to a multiple of *deltat_target*.
+    '''
+    tpad = 0.
+    for deltat in deltats:
+        up, down = get_resample_ratio(deltat, deltat_target)
+        if up != down:
+            tpad = max(tpad, 10*max(up, down) * deltat / up)
+
+    # whole number of target samples, so that cut traces stay contiguous
+    return num.ceil(tpad / deltat_target - 1e-6) * deltat_target
+
+
+def resample_trace(tr, deltat):
+    '''
+    Resample *tr* to *deltat* with polyphase filtering.
+
+    :returns: resampled copy of *tr*
+    '''
+    up, down = get_resample_ratio(tr.deltat, deltat)
+    ydata = resample_poly(
+        tr.get_ydata().astype(num.float64), up, down,
+        window=get_cached_resample_filter(up, down))
+
+    tr_resampled = tr.copy(data=False)
+    tr_resampled.deltat = deltat
+    tr_resampled.set_ydata(ydata)
+    return tr_resampled
+
+
+class ResampleCache(object):
+    '''
+    Least recently used cache of resampled traces.
+
+    Traces are identified by their NSLC id, time span and sampling interval,
+    so that repeated runs over the same time windows are resampled only
+    once.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def get(self, tr, deltat):
+        '''
+        Get *tr* resampled to *deltat*. *tr* is returned unchanged if it is
+        sampled at *deltat* already.
+        '''
+        if abs(tr.deltat - deltat) < 1e-6 * deltat:
+            return tr
+
+        key = (tr.nslc_id, tr.tmin, tr.tmax, tr.deltat, deltat)
+        try:
+            tr_resampled = self._cache.pop(key)
+        except KeyError:
+            tr_resampled = resample_trace(tr, deltat)
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = tr_resampled
+        return tr_resampled
+
+    def resample(self, traces, deltat, tcut=0.):
+        '''
+        Resample *traces* to *deltat* and cut *tcut* seconds from both ends
+        of each trace to remove the edge effects of the resampling filter.
+
+        The same number of samples is cut from all traces, so that
+        consecutive chunks of a chopper continue each other seamlessly.
+        '''
+        traces = [self.get(tr, deltat) for tr in traces]
+        ncut = int(round(tcut / deltat))
+        if ncut > 0:
+            traces_cut = []
+            for tr in traces:
+                tr_cut = tr.copy(data=False)
+                tr_cut.set_ydata(tr.get_ydata()[ncut:tr.data_len()-ncut])
+                tr_cut.shift(ncut*deltat)
+                traces_cut.append(tr_cut)
 
-    return lfilter(b, a, data)
+            traces = traces_cut
+
+        return traces
+
+    def clear(self):
+        self._cache.clear()
+
+
+class StreamBuffer(object):
+    '''
+    Continuously filtered samples of a fixed set of traces.
+
+    Filter states are carried over from one chunk to the next, so that every
+    sample is filtered exactly once. The last *noverlap* filtered samples are
+    kept in front of each newly pushed chunk to serve as padding for the
+    stacking. The buffer is reused between chunks so that memory usage does
+    not grow with the length of the processed time span.
+
+    The mean of the first chunk is removed from all subsequent data.
+    '''
+
+    def __init__(self, nslc_ids, deltat, noverlap, highpass=None,
+                 lowpass=None, order=4):
+
+        self.nslc_ids = tuple(nslc_ids)
+        self.deltat = deltat
+        self.noverlap = noverlap
+        self.sos = get_filter_sos(deltat, highpass, lowpass, order=order)
+        self.zi = None
+        self.mean = None
+        self.data = None
+        self.nbuffered = 0
+        self.tmin = None
+
+    def tnext(self):
+        ''' Expected start time of the next chunk. '''
+        if self.tmin is None:
+            return None
+
+        return self.tmin + self.nbuffered * self.deltat
+
+    def matches(self, traces):
+        ''' Check if *traces* continue the buffered data stream. '''
+        tnext = self.tnext()
+        return (
+            tnext is not None
+            and tuple(tr.nslc_id for tr in traces) == self.nslc_ids
+            and all(tr.deltat == self.deltat for tr in traces)
+            and abs(traces[0].tmin - tnext) < 0.5*self.deltat)
+
+    def push(self, traces):
+        '''
+        Filter and append *traces*.
+
+        :returns: tuple ``(tmin, data)`` with the start time and a view on the
+            buffered data of shape ``(ntraces, nbuffered)``. The view is only
+            valid until the next call to :py:meth:`push`.
+        '''
+        n = min(tr.data_len() for tr in traces)
+        ydata = num.array([tr.ydata[:n] for tr in traces], dtype=num.float64)
+
+        if self.mean is None:
+            self.mean = num.mean(ydata, axis=1)[:, num.newaxis]
+            self.tmin = traces[0].tmin
+
+        ydata -= self.mean
+
+        if self.sos is not None:
+            if self.zi is None:
+                # shape = (nsections, ntraces, 2)
+                self.zi = sosfilt_zi(self.sos)[:, num.newaxis, :] \
+                    * ydata[num.newaxis, :, :1]
+
+            ydata, self.zi = sosfilt(self.sos, ydata, axis=1, zi=self.zi)
+
+        nkeep = min(self.nbuffered, self.noverlap)
+        nbuffered = nkeep + n
+        if self.data is None or self.data.shape[1] < nbuffered:
+            data = num.empty((len(self.nslc_ids), nbuffered))
+            if nkeep:
+                data[:, :nkeep] = \
+                    self.data[:, self.nbuffered-nkeep:self.nbuffered]
+            self.data = data
+        elif nkeep:
+            self.data[:, :nkeep] = \
+                self.data[:, self.nbuffered-nkeep:self.nbuffered].copy()
+
+        self.tmin += (self.nbuffered - nkeep) * self.deltat
+        self.data[:, nkeep:nbuffered] = ydata
+        self.nbuffered = nbuffered
+
+        return self.tmin, self.data[:, :nbuffered]
+
+
+class FKResultWriter(object):
+    '''
+    Append-only writer for per-sample FK results.
+
+    The file starts with a magic string followed by blocks of continuous
+    samples. Each block consists of *tmin* and *deltat* (float64), the
+    number of samples *n* (int64) and the float32 arrays of maximum power,
+    back-azimuth [deg] and slowness [s/km], each of length *n*.
+    Use :py:func:`iter_fk_results` or :py:func:`load_fk_results` to read.
+    '''
+
+    magic = b'FKRESULTS1\n'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(self.magic)
+
+    def write(self, tmin, deltat, power, bazi, slow):
+        n = len(power)
+        num.array([tmin, deltat], dtype='<f8').tofile(self._file)
+        num.array([n], dtype='<i8').tofile(self._file)
+        for values in (power, bazi, slow):
+            num.asarray(values, dtype='<f4').tofile(self._file)
+
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def iter_fk_results(filename):
+    '''
+    Iterate over the blocks of a file written by :py:class:`FKResultWriter`.
+
+    Yields tuples ``(tmin, deltat, power, bazi, slow)``.
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(FKResultWriter.magic)) != FKResultWriter.magic:
+            raise ValueError('%s is not a FK result file' % filename)
+
+        while True:
+            header = num.fromfile(f, dtype='<f8', count=2)
+            if header.size < 2:
+                break
+
+            n = int(num.fromfile(f, dtype='<i8', count=1)[0])
+            values = num.fromfile(f, dtype='<f4', count=3*n).reshape((3, n))
+            yield (header[0], header[1]) + tuple(values)
+
+
+def load_fk_results(filename):
+    '''
+    Read a file written by :py:class:`FKResultWriter`.
+
+    :returns: tuple of arrays ``(times, power, bazi, slow)``
+    '''
+    blocks = [
+        (tmin + num.arange(len(power)) * deltat, power, bazi, slow)
+        for (tmin, deltat, power, bazi, slow) in iter_fk_results(filename)]
+
+    if not blocks:
+        return tuple(num.zeros(0) for i in range(4))
+
+    return tuple(num.concatenate(x) for x in zip(*blocks))
+
+
+class BeamPowerDetector(object):
+    '''
+    Detector on the per-sample maximum beam power.
+
+    With *method* ``'sta/lta'``, the characteristic function is the ratio of
+    recursive short and long term averages of the power, otherwise it is the
+    power itself. A detection is declared where the characteristic function
+    rises above *threshold_on*, and the detector is armed again when it falls
+    below *threshold_off*. Averages and trigger state are carried over from
+    one chunk to the next, so that contiguous chunks give the same detections
+    as one long series.
+    '''
+
+    def __init__(self, deltat, method='sta/lta', tsta=1., tlta=10.,
+                 threshold_on=3., threshold_off=None):
+
+        self.deltat = deltat
+        self.method = method
+        self.nsta = max(1, int(round(tsta / deltat)))
+        self.nlta = max(1, int(round(tlta / deltat)))
+        self.threshold_on = threshold_on
+        if threshold_off is None:
+            threshold_off = threshold_on
+        self.threshold_off = threshold_off
+        self.reset()
+
+    def reset(self):
+        self.zi_sta = None
+        self.zi_lta = None
+        self.triggered = False
+        self.nsamples = 0
+        self.tnext = None
+        self.peak = None
+
+    def characteristic_function(self, power):
+        if self.method != 'sta/lta':
+            return power
+
+        csta = 1. / self.nsta
+        clta = 1. / self.nlta
+        if self.zi_sta is None:
+            self.zi_sta = lfilter_zi([csta], [1., csta-1.]) * power[0]
+            self.zi_lta = lfilter_zi([clta], [1., clta-1.]) * power[0]
+
+        sta, self.zi_sta = lfilter(
+            [csta], [1., csta-1.], power, zi=self.zi_sta)
+        lta, self.zi_lta = lfilter(
+            [clta], [1., clta-1.], power, zi=self.zi_lta)
+
+        cf = sta / num.where(lta > 0., lta, 1.)
+
+        # long term average is not settled yet
+        cf[:max(0, self.nlta - self.nsamples)] = 0.
+        return cf
+
+    def continues(self, tmin):
+        return self.tnext is None or abs(tmin - self.tnext) <= 0.5*self.deltat
+
+    def detect(self, tmin, power):
+        '''
+        Process the next chunk of maximum power samples starting at *tmin*.
+
+        State is reset if the chunk does not continue the previous one.
+
+        :returns: indices of trigger onsets within *power*
+        '''
+        state = self.trigger_state(tmin, power)
+        return num.where(state[1:] & ~state[:-1])[0]
+
+    def detect_peaks(self, tmin, power, values):
+        '''
+        Process the next chunk of maximum power samples starting at *tmin* and
+        report detections when their trigger is switched off.
+
+        A trigger still on at the end of the chunk is completed by the
+        following chunks or by :py:meth:`flush`.
+
+        :param values: array with an entry for each sample of *power*
+        :returns: list of ``(tonset, tpeak, value)`` with the onset time, the
+            time of maximum power between trigger on and off, and the entry
+            of *values* at that maximum
+        '''
+        detections = []
+        if not self.continues(tmin):
+            detections.extend(self.flush())
+
+        power = num.asarray(power, dtype=num.float64)
+        if power.size == 0:
+            return detections
+
+        state = self.trigger_state(tmin, power)
+
+        # triggered sample ranges, the first one may continue a trigger of
+        # a previous chunk
+        istarts = num.where(state[1:] & ~state[:-1])[0]
+        iends = num.where(~state[1:] & state[:-1])[0]
+        if state[0]:
+            istarts = num.concatenate(([0], istarts))
+        if state[-1]:
+            iends = num.concatenate((iends, [power.size]))
+
+        for istart, iend in zip(istarts, iends):
+            imax = istart + num.argmax(power[istart:iend])
+            if istart == 0 and state[0] and self.peak is not None:
+                tonset, tpeak, power_peak, value = self.peak
+                if power[imax] > power_peak:
+                    tpeak = tmin + imax*self.deltat
+                    power_peak = power[imax]
+                    value = values[imax]
+            else:
+                tonset = tmin + istart*self.deltat
+                tpeak = tmin + imax*self.deltat
+                power_peak = power[imax]
+                value = values[imax]
+
+            self.peak = tonset, tpeak, power_peak, value
+            if iend < power.size:
+                detections.extend(self.flush())
+
+        return detections
+
+    def flush(self):
+        '''
+        Complete a detection whose trigger is still on.
+
+        :returns: list with ``(tonset, tpeak, value)`` of the pending
+            detection, if any
+        '''
+        if self.peak is None:
+            return []
+
+        tonset, tpeak, _, value = self.peak
+        self.peak = None
+        return [(tonset, tpeak, value)]
+
+    def trigger_state(self, tmin, power):
+        '''
+        Trigger state before and at each sample of a chunk of maximum power.
+
+        :returns: boolean array of length ``len(power) + 1``
+        '''
+        if not self.continues(tmin):
+            self.reset()
+
+        power = num.asarray(power, dtype=num.float64)
+        if power.size == 0:
+            return num.array([self.triggered])
+
+        cf = self.characteristic_function(power)
+        self.nsamples += power.size
+        self.tnext = tmin + power.size * self.deltat
+
+        # +1 where switched on, -1 where switched off; the trigger state is
+        # the last switch, propagated forward
+        switches = num.zeros(power.size + 1, dtype=num.int8)
+        switches[0] = 1 if self.triggered else -1
+        switches[1:][cf < self.threshold_off] = -1
+        switches[1:][cf > self.threshold_on] = 1
+
+        iswitch = num.where(switches != 0, num.arange(switches.size), 0)
+        state = switches[num.maximum.accumulate(iswitch)] > 0
+
+        self.triggered = bool(state[-1])
+        return state
 
 
 def value_to_index(value, range_min, range_max, range_delta, clip=True):
@@ -161,7 +947,878 @@ def value_to_index(value, range_min, range_max, range_delta, clip=True):
     if clip:
         indices = num.clip(indices, 0, (range_max-range_min)/range_delta)
 
-    return num.asarray(indices, dtype=num.int)
+    return num.asarray(indices, dtype=num.int64)
+
+
+def lanczos_taps(delays, a=3):
+    '''
+    Windowed-sinc (Lanczos) interpolation taps for fractional *delays*.
+
+    :param delays: delays in samples, arbitrary shape
+    :param a: half-width of the Lanczos window in samples
+
+    Delaying a signal *x* by *delays* is approximated by
+    ``sum_j weights[..., j] * x[i - ishifts[..., j]]``.
+
+    :returns: tuple ``(ishifts, weights)`` each of shape
+        ``delays.shape + (2*a,)``
+    '''
+    delays = num.asarray(delays, dtype=num.float64)
+    ifloor = num.floor(delays)
+    frac = delays - ifloor
+    js = num.arange(-a+1, a+1)
+
+    x = js - frac[..., num.newaxis]
+    weights = num.sinc(x) * num.sinc(x / a)
+    weights /= num.sum(weights, axis=-1)[..., num.newaxis]
+
+    ishifts = ifloor.astype(num.int32)[..., num.newaxis] + js
+    return ishifts.astype(num.int32), weights
+
+
+def lanczos_gather(ydata, positions, a=3):
+    '''
+    Interpolate the rows of *ydata* at fractional sample *positions*.
+
+    :param ydata: data of shape ``(ntraces, nsamples)``
+    :param positions: sample positions of shape ``(ntraces, npositions)``
+
+    Positions outside of the data are clipped to the data range.
+
+    :returns: interpolated values of shape ``(ntraces, npositions)``
+    '''
+    ydata = num.asarray(ydata)
+    ishifts, weights = lanczos_taps(-num.asarray(positions), a=a)
+    indices = num.clip(-ishifts, 0, ydata.shape[1]-1)
+    itraces = num.arange(ydata.shape[0])[:, num.newaxis, num.newaxis]
+    return num.sum(ydata[itraces, indices] * weights, axis=-1)
+
+
+def make_stacker(arrays, offsets, shift_table, shifts, deltat, method,
+                 lengthout, offsetout=0, fk_window=2., fmin=None, fmax=None,
+                 fractional=False, nparallel=None, impl='openmp'):
+    '''
+    Get a function which stacks *arrays* for a subset of grid points.
+
+    The returned function takes an index array or slice into the rows of
+    *shift_table* and *shifts* and returns the frames of shape
+    ``(ngridpoints_subset, lengthout)``. *method* is the *method* argument of
+    :py:func:`pyrocko.parstack.parstack` or ``None`` for
+    :py:func:`fk_frequency_domain`.
+
+    If *fractional* is ``True`` and *method* is 0 (stack), delays are not
+    rounded to full samples. Instead, each trace enters the stack with the
+    taps of a windowed-sinc interpolator (:py:func:`lanczos_taps`) as
+    weights, so that parstack performs the fractional delay and sum.
+
+    *impl* selects the :py:func:`pyrocko.parstack.parstack` implementation
+    (``'openmp'`` or ``'numpy'``).
+    '''
+    parstack_kwargs = {}
+    if nparallel is not None:
+        parstack_kwargs['nparallel'] = nparallel
+
+    window_spectra = None
+    if method is None:
+        # spectra are shared by all subsets of the grid
+        window_spectra = fk_window_spectra(
+            arrays, deltat, nwindow=int(round(fk_window / deltat)),
+            fmin=fmin, fmax=fmax)
+
+    def stack(igrid):
+        if method is None:
+            return fk_frequency_domain(
+                None, shift_table[igrid], deltat,
+                nwindow=window_spectra['nwindow'],
+                lengthout=lengthout,
+                offsetout=offsetout,
+                window_spectra=window_spectra)
+        elif fractional and method == 0:
+            ishifts, weights = lanczos_taps(shift_table[igrid] / deltat)
+            ngrid, ntraces, ntaps = ishifts.shape
+
+            # tap-major ordering of the (trace, tap) combinations
+            ishifts = num.ascontiguousarray(
+                ishifts.transpose((0, 2, 1)).reshape((ngrid, -1)))
+            weights = num.ascontiguousarray(
+                weights.transpose((0, 2, 1)).reshape((ngrid, -1)))
+
+            frames, ioff = parstack.parstack(
+                list(arrays) * ntaps,
+                num.tile(offsets, ntaps).astype(num.int32),
+                ishifts, weights, method,
+                offsetout=offsetout,
+                lengthout=lengthout,
+                impl=impl,
+                **parstack_kwargs)
+
+            return frames
+
+        else:
+            shifts_use = num.ascontiguousarray(shifts[igrid])
+            frames, ioff = parstack.parstack(
+                arrays, offsets, shifts_use, num.ones(shifts_use.shape),
+                method,
+                offsetout=offsetout,
+                lengthout=lengthout,
+                impl=impl,
+                **parstack_kwargs)
+
+            return frames
+
+    return stack
+
+
+def reduce_grid(stack, ngridpoints, lengthout, nmax_bytes=64*1024**2):
+    '''
+    Maximum over the grid without holding all frames in memory.
+
+    :param stack: function as returned by :py:func:`make_stacker`
+    :param nmax_bytes: approximate size of the frames of one chunk of grid
+        points
+
+    The grid is stacked in chunks of consecutive grid points, keeping only
+    the running per-sample maximum and its grid index as well as the maximum
+    over time of every grid point. Peak memory is of order
+    ``lengthout + ngridpoints`` plus one chunk.
+
+    :returns: tuple ``(max_powers, argmax, grid_max)`` of shapes
+        ``(lengthout,)``, ``(lengthout,)`` and ``(ngridpoints,)``
+    '''
+    nchunk = max(1, int(nmax_bytes // (8 * lengthout)))
+    max_powers = num.full(lengthout, -num.inf)
+    argmax = num.zeros(lengthout, dtype=num.int64)
+    grid_max = num.empty(ngridpoints)
+    isamples = num.arange(lengthout)
+
+    for igrid in range(0, ngridpoints, nchunk):
+        chunk = slice(igrid, min(igrid+nchunk, ngridpoints))
+        frames = stack(chunk)
+
+        imax = num.argmax(frames, axis=0)
+        vmax = frames[imax, isamples]
+        better = vmax > max_powers
+        max_powers[better] = vmax[better]
+        argmax[better] = imax[better] + igrid
+
+        grid_max[chunk] = num.max(frames, axis=1)
+
+    return max_powers, argmax, grid_max
+
+
+def get_bazi_period(bazis):
+    '''
+    Number of distinct back-azimuths of a regular grid which covers the full
+    circle, e.g. 180 for ``num.arange(0., 362., 2.)``, or ``None`` if the
+    grid does not repeat.
+    '''
+    dbazi = bazis[1] - bazis[0]
+    n_period = int(round(360. / dbazi))
+    if abs(n_period*dbazi - 360.) < 1e-6 and n_period < len(bazis):
+        return n_period
+
+    return None
+
+
+def hierarchical_grid_search(stack, n_bazis, n_slow, lengthout, n_maxsearch,
+                             coarse_factor=4, ntop=3, n_bazis_period=None):
+    '''
+    Coarse-to-fine evaluation of a back-azimuth/slowness grid.
+
+    :param stack: callable which takes an array of grid point indices and
+        returns the corresponding frames of shape ``(len(indices),
+        lengthout)``
+    :param n_bazis,n_slow: dimensions of the fine grid
+    :param n_maxsearch: number of samples per block in which maxima are
+        searched
+    :param coarse_factor: decimation of the fine grid in both dimensions
+    :param ntop: number of maxima of the coarse grid refined per block
+    :param n_bazis_period: number of distinct back-azimuths in 360 degrees,
+        if smaller than *n_bazis*. Back-azimuth indices from
+        *n_bazis_period* on repeat the first ones (e.g. a 360 degree
+        endpoint) and are copied instead of being evaluated.
+
+    The coarse grid is evaluated first. For each block of *n_maxsearch*
+    samples the *ntop* strongest coarse grid points are determined, and the
+    fine grid is evaluated in the neighbourhood of these points only.
+    Back-azimuth neighbourhoods wrap around.
+
+    Grid points of the fine grid which have not been evaluated take the value
+    of the nearest coarse grid point.
+
+    :returns: tuple ``(frames, nevaluated)`` with *frames* of shape
+        ``(n_bazis*n_slow, lengthout)`` and the number of evaluated grid
+        points
+    '''
+    n_period = n_bazis
+    if n_bazis_period is not None:
+        n_period = min(n_bazis_period, n_bazis)
+
+    f = int(coarse_factor)
+    ib_coarse = num.arange(0, n_period, f)
+    is_coarse = num.arange(0, n_slow, f)
+    i_coarse = (ib_coarse[:, num.newaxis]*n_slow
+                + is_coarse[num.newaxis, :]).ravel()
+
+    frames_coarse = stack(i_coarse)
+
+    # strongest coarse grid points per block
+    nblocks = -(-lengthout // n_maxsearch)
+    npadded = nblocks * n_maxsearch - lengthout
+    block_max = num.pad(
+        frames_coarse, ((0, 0), (0, npadded)), mode='edge').reshape(
+            (i_coarse.size, nblocks, n_maxsearch)).max(axis=2)
+
+    ntop = min(ntop, i_coarse.size)
+    itop = num.argpartition(-block_max, ntop-1, axis=0)[:ntop]
+    itop = num.unique(itop)
+
+    # fine grid neighbourhoods of selected coarse grid points
+    ioffsets = num.arange(-f+1, f)
+    ib_fine = (ib_coarse[itop // is_coarse.size][:, num.newaxis]
+               + ioffsets[num.newaxis, :]) % n_period
+    is_fine = is_coarse[itop % is_coarse.size][:, num.newaxis] \
+        + ioffsets[num.newaxis, :]
+    is_fine = num.clip(is_fine, 0, n_slow-1)
+
+    i_fine = num.unique(
+        (ib_fine[:, :, num.newaxis]*n_slow
+         + is_fine[:, num.newaxis, :]).ravel())
+    i_fine = num.setdiff1d(i_fine, i_coarse, assume_unique=True)
+
+    # nearest coarse grid point of every fine grid point
+    ib_near = num.round(num.arange(n_bazis) / float(f)).astype(num.int64)
+    if n_period < n_bazis:
+        ib_near %= ib_coarse.size
+    else:
+        ib_near = num.clip(ib_near, 0, ib_coarse.size-1)
+    is_near = num.clip(num.round(
+        num.arange(n_slow) / float(f)).astype(num.int64),
+        0, is_coarse.size-1)
+    i_near = (ib_near[:, num.newaxis]*is_coarse.size
+              + is_near[num.newaxis, :]).ravel()
+
+    frames = frames_coarse[i_near]
+    if i_fine.size:
+        frames[i_fine] = stack(i_fine)
+
+    # repeated back-azimuths
+    frames[n_period*n_slow:] = frames[:(n_bazis-n_period)*n_slow]
+
+    return frames, i_coarse.size + i_fine.size
+
+
+def cross_bearing_location(lats, lons, bazis, radius=100*km, n=201,
+                           weights=None):
+    '''
+    Locate a source by intersecting back-azimuths observed at several arrays.
+
+    The misfit is evaluated on a regular grid of *n* x *n* points within
+    *radius* [m] around the mean of the array positions. It is the weighted
+    root mean square difference between the observed back-azimuths and the
+    azimuths from the arrays to the grid points.
+
+    :param lats,lons: array centers [deg]
+    :param bazis: observed back-azimuths [deg]
+
+    :returns: tuple ``(lat, lon, misfit)`` of the best grid point, with
+        *misfit* in [deg]
+    '''
+    lats = num.asarray(lats, dtype=num.float64)
+    lons = num.asarray(lons, dtype=num.float64)
+    bazis = num.asarray(bazis, dtype=num.float64)
+    if weights is None:
+        weights = num.ones(bazis.size)
+
+    lat0 = num.mean(lats)
+    lon0 = num.mean(lons)
+    grid = num.linspace(-radius, radius, n)
+    norths, easts = [x.ravel() for x in num.meshgrid(grid, grid)]
+    grid_lats, grid_lons = ortho.ne_to_latlon(lat0, lon0, norths, easts)
+
+    # shape = (narrays, ngridpoints)
+    azimuths = ortho.azimuth_numpy(
+        lats[:, num.newaxis], lons[:, num.newaxis],
+        grid_lats[num.newaxis, :], grid_lons[num.newaxis, :])
+
+    residuals = (azimuths - bazis[:, num.newaxis] + 180.) % 360. - 180.
+    misfits = num.sqrt(
+        num.sum(weights[:, num.newaxis] * residuals**2, axis=0) /
+        num.sum(weights))
+
+    ibest = num.argmin(misfits)
+    return grid_lats[ibest], grid_lons[ibest], misfits[ibest]
+
+
+def adjust_polar_axis(ax):
+    ax.set_theta_zero_location('N')
+    ax.set_theta_direction(-1)
+    ax.set_xticks([0, num.pi/2., num.pi, 3*num.pi/2])
+    ax.set_xticklabels(['N', 'E', 'S', 'W'])
+
+
+def decimate_frames(frames, times, nframes_max):
+    '''
+    Reduce *frames* to at most *nframes_max* time samples.
+
+    Consecutive samples are grouped into blocks and the maximum of each grid
+    point within a block is taken, so that short coherent arrivals are not
+    skipped.
+
+    :returns: tuple ``(frames, times)`` with the decimated frames and the
+        start times of the blocks
+    '''
+    ngridpoints, nsamples = frames.shape
+    nblock = max(1, -(-nsamples // int(nframes_max)))
+    if nblock == 1:
+        return frames, times
+
+    nblocks = -(-nsamples // nblock)
+    padded = num.pad(
+        frames, ((0, 0), (0, nblocks*nblock - nsamples)), mode='edge')
+
+    return (padded.reshape((ngridpoints, nblocks, nblock)).max(axis=2),
+            times[::nblock])
+
+
+def add_polar_movie_artists(fig, frames, bazis, slownesses, animated=False):
+    '''
+    Add a polar back-azimuth/slowness mesh showing the first of *frames* and
+    a time label to *fig*.
+
+    :returns: tuple ``(ax, mesh, label)``
+    '''
+    n_bazis = len(bazis)
+    n_slow = len(slownesses)
+
+    def edges(x):
+        dx = x[1] - x[0] if len(x) > 1 else 1.
+        return num.concatenate((x - 0.5*dx, [x[-1] + 0.5*dx]))
+
+    theta, r = num.meshgrid(
+        edges(bazis)*d2r, edges(slownesses)*km, indexing='ij')
+
+    ax = fig.add_subplot(111, projection='polar')
+    adjust_polar_axis(ax)
+
+    mesh = ax.pcolormesh(
+        theta, r, frames[:, 0].reshape((n_bazis, n_slow)),
+        vmin=num.min(frames), vmax=num.max(frames), animated=animated)
+
+    label = ax.text(
+        0.5, 0.01, '', transform=fig.transFigure,
+        horizontalalignment='center', verticalalignment='bottom',
+        animated=animated)
+
+    return ax, mesh, label
+
+
+def make_polar_movie(fig, frames, times, bazis, slownesses,
+                     nframes_max=250, interval=40.):
+    '''
+    Animate *frames* on a polar back-azimuth/slowness mesh in *fig*.
+
+    The mesh is created once and its values are replaced for every frame.
+    Frames are decimated to *nframes_max* with :py:func:`decimate_frames`.
+
+    :returns: :py:class:`matplotlib.animation.FuncAnimation` instance. Keep
+        a reference to it for as long as the animation should run.
+    '''
+    frames, times = decimate_frames(frames, times, nframes_max)
+    _, mesh, label = add_polar_movie_artists(fig, frames, bazis, slownesses)
+
+    def update(iframe):
+        mesh.set_array(frames[:, iframe])
+        label.set_text(util.time_to_str(times[iframe]))
+        return mesh, label
+
+    return FuncAnimation(
+        fig, update,
+        frames=frames.shape[1],
+        interval=interval,
+        repeat=False,
+        blit=True)
+
+
+def save_polar_movie(filename, frames, times, bazis, slownesses,
+                     nframes_max=100, fps=25, dpi=80):
+    '''
+    Render a polar movie of *frames* to an animated GIF file.
+
+    Uses the Agg backend and Pillow, so no display and no external encoder
+    binaries are required. The figure background is rendered once, only the
+    mesh, axes and time label are drawn for each frame. All frames share
+    the color palette of the first one.
+
+    The extension ``.gif`` is appended to *filename* if missing.
+
+    :returns: name of the written file
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from PIL import Image
+
+    if not filename.lower().endswith('.gif'):
+        filename += '.gif'
+
+    frames, times = decimate_frames(frames, times, nframes_max)
+
+    fig = Figure(figsize=(5., 5.), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax, mesh, label = add_polar_movie_artists(
+        fig, frames, bazis, slownesses, animated=True)
+
+    # grid and radial labels lie on top of the mesh, so the axes are drawn
+    # for each frame rather than into the background
+    overlays = [ax.xaxis, ax.yaxis]
+    for artist in overlays:
+        artist.set_animated(True)
+
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    images = []
+    for iframe in range(frames.shape[1]):
+        canvas.restore_region(background)
+        mesh.set_array(frames[:, iframe])
+        label.set_text(util.time_to_str(times[iframe]))
+        for artist in [mesh] + overlays + [label]:
+            fig.draw_artist(artist)
+
+        image = Image.frombuffer(
+            'RGBA', canvas.get_width_height(), canvas.buffer_rgba(),
+            'raw', 'RGBA', 0, 1).convert('RGB')
+
+        if images:
+            images.append(image.quantize(palette=images[0]))
+        else:
+            images.append(image.quantize(colors=255))
+
+    util.ensuredirs(filename)
+    images[0].save(
+        filename, save_all=True, append_images=images[1:],
+        duration=int(round(1000. / fps)), loop=0)
+
+    return filename
+
+
+class StageTimer(object):
+    '''
+    Accumulates wall time and peak memory of named processing stages.
+
+    Peak memory is the maximum of memory allocated on top of what was in use
+    when a stage was entered. It is only recorded while :py:mod:`tracemalloc`
+    is tracing, otherwise it is reported as 0.
+    '''
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        tracing = tracemalloc is not None and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            mem_start = tracemalloc.get_traced_memory()[0]
+
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - t_start
+            peak = 0
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - mem_start
+
+            wall_sum, peak_max = self.stages.get(name, (0., 0))
+            self.stages[name] = (wall_sum + wall, max(peak_max, peak))
+
+
+def process_window(ydata, offsets, tmin, tmax, deltat, shift_table, shifts,
+                   bazis, slownesses, npad, lengthout, offsetout=0, method=0,
+                   highpass=None, lowpass=None, taper=None, fk_window=2.,
+                   search_factor=1., hierarchical=False, coarse_factor=4,
+                   ntop=3, reduce=False, fractional=False, want_pws=False,
+                   want_frames=True, nparallel=None, impl='openmp',
+                   timer=None):
+    '''
+    Process a single window of array data.
+
+    :param ydata: raw data of shape ``(ntraces, lengthout + 2*npad)``
+    :param offsets: sample offsets of the traces
+    :param tmin,tmax: time span of the window including padding
+    :param shift_table,shifts: shift table as returned by
+        :py:meth:`ShiftTableCache.get`
+    :param bazis,slownesses: grid of back-azimuths [deg] and slownesses [s/m]
+    :param method: *method* argument of :py:func:`pyrocko.parstack.parstack`
+        or ``None`` for :py:func:`fk_frequency_domain`
+    :param hierarchical: use :py:func:`hierarchical_grid_search` with
+        *coarse_factor* and *ntop* instead of evaluating the full grid
+    :param reduce: use :py:func:`reduce_grid` so that the full frames are
+        never held in memory. Implies that *frames* are not returned. Ignored
+        if *hierarchical* is set.
+    :param fractional: stack with fractional delays, see
+        :py:func:`make_stacker`. The beam is interpolated accordingly.
+    :param want_pws: add a phase weighted beam, see
+        :py:func:`phase_weighted_stack`
+    :param want_frames: if ``False``, *frames* and preprocessed *arrays* are
+        dropped from the result to save memory and transfer time.
+    :param impl: :py:func:`pyrocko.parstack.parstack` implementation
+    :param timer: :py:class:`StageTimer` which collects timings of the
+        stages filter, parstack, spline and beam
+
+    This function does not depend on the viewer, so that windows can be
+    processed in worker processes.
+
+    :returns: dict of results
+    '''
+    n_bazis = len(bazis)
+    n_slow = len(slownesses)
+    if timer is None:
+        timer = StageTimer()
+
+    with timer.stage('filter'):
+        arrays = list(preprocess_arrays(
+            ydata, deltat, highpass=highpass, lowpass=lowpass, taper=taper))
+
+    n_maxsearch = int(npad*search_factor)
+    nevaluated = n_bazis * n_slow
+
+    with timer.stage('parstack'):
+        stack = make_stacker(
+            arrays, offsets, shift_table, shifts, deltat, method, lengthout,
+            offsetout=offsetout, fk_window=fk_window, fmin=highpass,
+            fmax=lowpass, fractional=fractional, nparallel=nparallel,
+            impl=impl)
+
+        if hierarchical:
+            frames, nevaluated = hierarchical_grid_search(
+                stack, n_bazis, n_slow, lengthout, n_maxsearch,
+                coarse_factor=coarse_factor, ntop=ntop,
+                n_bazis_period=get_bazi_period(bazis))
+        elif reduce:
+            frames = None
+            max_powers, _argmax, grid_max = reduce_grid(
+                stack, nevaluated, lengthout)
+        else:
+            frames = stack(slice(None))
+
+        if frames is not None:
+            max_powers = num.max(frames, axis=0)
+            _argmax = num.argmax(frames, axis=0)
+            grid_max = num.max(frames, axis=1)
+
+    with timer.stage('spline'):
+        times = tmin + num.arange(lengthout) * deltat
+
+        # power maxima in blocks
+        i_max_blocked = search_max_block(
+            n_maxsearch=n_maxsearch, data=max_powers)
+
+        max_powers_weights = max_powers - num.min(max_powers)
+        max_powers_weights /= num.max(max_powers_weights)
+        max_powers_weights *= max_powers_weights
+        weights = max_powers_weights[i_max_blocked]
+        block_max_times = times[i_max_blocked]
+
+        imax_bazi_all, imax_slow_all = num.unravel_index(
+            _argmax, (n_bazis, n_slow))
+
+        local_max_bazi = bazis[imax_bazi_all][i_max_blocked]
+        local_max_slow = slownesses[imax_slow_all][i_max_blocked]*km
+
+        k_north = num.sin(local_max_bazi * d2r) * local_max_slow
+        k_east = num.cos(local_max_bazi * d2r) * local_max_slow
+
+        smooth = 4e7
+
+        spline_north = UnivariateSpline(
+            block_max_times, k_north, w=weights,
+            s=smooth
+        )
+
+        spline_east = UnivariateSpline(
+            block_max_times, k_east, w=weights,
+            s=smooth,
+        )
+
+        k_north_fit = spline_north(times)
+        k_east_fit = spline_east(times)
+
+        bazi_fitted = num.arctan2(k_east_fit, k_north_fit) / d2r
+        bazi_fitted -= 90.
+        bazi_fitted *= -1.
+        bazi_fitted[num.where(bazi_fitted < 0.)] += 360.
+
+        spline_slow = UnivariateSpline(
+            block_max_times,
+            local_max_slow,
+            w=weights,
+        )
+
+        slow_fitted = spline_slow(times)
+        i_bazi_fitted = value_to_index(
+            bazi_fitted, bazis[0], bazis[-1], bazis[1]-bazis[0])
+
+        i_slow_fitted = value_to_index(
+            slow_fitted, slownesses[0]*km, slownesses[-1]*km,
+            (slownesses[1]-slownesses[0])*km)
+
+        i_shift = num.ravel_multi_index(
+            num.vstack((i_bazi_fitted, i_slow_fitted)),
+            (n_bazis, n_slow),
+        )
+
+    with timer.stage('beam'):
+        # traces aligned along the fitted back-azimuth/slowness,
+        # shape = (ntraces, lengthout)
+        i_base = num.arange(lengthout, dtype=num.int64) + npad
+        if fractional:
+            positions = num.clip(
+                i_base - shift_table[i_shift].T / deltat,
+                npad, lengthout+npad)
+            aligned = lanczos_gather(ydata, positions)
+        else:
+            isorting = num.clip(
+                i_base - shifts[i_shift].T, npad, lengthout+npad)
+            aligned = ydata[num.arange(len(ydata))[:, num.newaxis], isorting]
+
+        stack_trace = num.sum(aligned, axis=0)
+        if want_pws:
+            pws_trace = phase_weighted_stack(aligned)
+
+    result = dict(
+        times=times,
+        max_powers=max_powers,
+        bazi=bazis[imax_bazi_all],
+        slow=slownesses[imax_slow_all]*km,
+        block_max_times=block_max_times,
+        local_max_bazi=local_max_bazi,
+        local_max_slow=local_max_slow,
+        bazi_fitted=bazi_fitted,
+        slow_fitted=slow_fitted,
+        stack_trace=stack_trace,
+        grid_max=grid_max,
+        nevaluated=nevaluated)
+
+    if want_pws:
+        result['pws_trace'] = pws_trace
+
+    if want_frames:
+        result.update(frames=frames, arrays=arrays)
+
+    return result
+
+
+@contextmanager
+def worker_pool(nworkers, func):
+    '''
+    Context manager providing a process pool to run *func* in, or ``None``.
+
+    Snuffler imports snufflings with their directory temporarily prepended
+    to :py:data:`sys.path` and removes them from :py:data:`sys.modules`
+    afterwards, so that functions of this module can neither be pickled nor
+    imported by worker processes. Both are restored while the pool is alive.
+
+    ``None`` is provided if *nworkers* is 1 or if *func* cannot be pickled,
+    in which case the caller has to process serially.
+    '''
+    if nworkers <= 1:
+        yield None
+        return
+
+    name = _module.__name__
+    dirname = os.path.dirname(os.path.abspath(_module.__file__))
+    add_module = name not in sys.modules
+    add_path = dirname not in sys.path
+    if add_module:
+        sys.modules[name] = _module
+
+    if add_path:
+        sys.path.append(dirname)
+
+    pool = None
+    try:
+        try:
+            pickle.dumps(func)
+            if hasattr(multiprocessing, 'get_context') and \
+                    'fork' in multiprocessing.get_all_start_methods():
+                pool = multiprocessing.get_context('fork').Pool(nworkers)
+            else:
+                pool = multiprocessing.Pool(nworkers)
+
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            logger.warning(
+                'cannot use worker processes, processing serially: %s' % e)
+
+        yield pool
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+        if add_path:
+            sys.path.remove(dirname)
+
+        if add_module:
+            del sys.modules[name]
+
+
+BENCHMARK_STAGES = (
+    'read', 'filter', 'shift-table', 'parstack', 'spline', 'beam')
+
+
+def synthetic_stations(nstations, aperture=5*km, layout='random', lat=50.,
+                       lon=10., seed=0):
+    '''
+    Generate a synthetic array of *nstations* stations.
+
+    :param aperture: diameter of the array [m]
+    :param layout: ``'random'`` (uniformly distributed within a disk) or
+        ``'ring'`` (one station in the center, the others on a ring)
+    '''
+    rstate = num.random.RandomState(seed)
+    if layout == 'random':
+        radii = 0.5 * aperture * num.sqrt(rstate.uniform(size=nstations))
+        phis = rstate.uniform(0., 2.*num.pi, size=nstations)
+    elif layout == 'ring':
+        radii = num.ones(nstations) * 0.5 * aperture
+        radii[0] = 0.
+        phis = num.zeros(nstations)
+        phis[1:] = num.linspace(0., 2.*num.pi, nstations-1, endpoint=False)
+    else:
+        raise ValueError('unknown station layout: %s' % layout)
+
+    lats, lons = ortho.ne_to_latlon(
+        lat, lon, radii*num.cos(phis), radii*num.sin(phis))
+
+    return [model.Station(
+        network='XX', station='S%03i' % i, location='', lat=float(lats[i]),
+        lon=float(lons[i])) for i in range(nstations)]
+
+
+def synthetic_plane_wave(stations, center_station, deltat, tmin, duration,
+                         bazi=80., slowness=0.07/km, fmin=0.5, fmax=5.,
+                         noise=0.1, seed=0):
+    '''
+    Generate traces of band limited random plane wave recorded at *stations*.
+
+    The plane wave with back-azimuth *bazi* [deg] and *slowness* [s/m] is
+    delayed exactly in the frequency domain. Gaussian noise with standard
+    deviation *noise* relative to the signal is added.
+    '''
+    rstate = num.random.RandomState(seed)
+    n = int(round(duration / deltat))
+    freqs = num.fft.rfftfreq(n, deltat)
+    spectrum = num.fft.rfft(rstate.normal(size=n))
+    spectrum[(freqs < fmin) | (freqs > fmax)] = 0.
+
+    delays = get_shifts(stations, center_station, [bazi], [slowness])[0]
+    ydata = num.fft.irfft(
+        spectrum[num.newaxis, :] *
+        num.exp(2.j*num.pi*freqs[num.newaxis, :]*delays[:, num.newaxis]), n)
+    ydata /= num.std(ydata)
+    ydata += rstate.normal(scale=noise, size=ydata.shape)
+
+    return [trace.Trace(
+        s.network, s.station, s.location, 'BHZ', tmin=tmin, deltat=deltat,
+        ydata=ydata[i]) for i, s in enumerate(stations)]
+
+
+def benchmark(nstations, delta_bazi, tinc, impl='openmp', deltat=0.01,
+              slowness_min=0.01, slowness_max=0.2, slowness_delta=0.002,
+              method=0, nwindows=2, highpass=0.5, lowpass=5., noise=0.1,
+              layout='random', aperture=5*km, timer=None, **kwargs):
+    '''
+    Run the FK processing chain headlessly on synthetic plane wave data.
+
+    Data are read from an in-memory pile with the same windowing as
+    :py:meth:`FK.call`. Slownesses are given in [s/km]. Additional *kwargs*
+    are passed to :py:func:`process_window`.
+
+    :returns: :py:class:`StageTimer` holding timings of the stages listed in
+        :py:data:`BENCHMARK_STAGES`, accumulated over *nwindows* windows
+    '''
+    if timer is None:
+        timer = StageTimer()
+
+    stations = synthetic_stations(nstations, aperture=aperture, layout=layout)
+    center_station = get_center_station(stations, select_closest=True)
+    bazis = num.arange(0., 360.+delta_bazi, delta_bazi)
+    slownesses = num.arange(slowness_min/km, slowness_max/km,
+                            slowness_delta/km)
+
+    with timer.stage('shift-table'):
+        shift_table, shifts = ShiftTableCache().get(
+            stations, center_station, bazis, slownesses, deltat)
+
+    npad = num.max(num.abs(shifts))
+    tpad = npad * deltat
+    lengthout = int(round(tinc / deltat))
+
+    traces_pile = pile_mod.Pile()
+    traces_pile.add_file(pile_mod.MemTracesFile(None, synthetic_plane_wave(
+        stations, center_station, deltat, tmin=0.,
+        duration=nwindows*tinc + 2*tpad + 1., fmin=highpass, fmax=lowpass,
+        noise=noise)))
+
+    windows = traces_pile.chopper(
+        tmin=tpad, tmax=tpad + nwindows*tinc, tinc=tinc, tpad=tpad,
+        want_incomplete=False)
+
+    while True:
+        with timer.stage('read'):
+            traces = next(windows, None)
+            if traces:
+                ydata = num.array([tr.get_ydata() for tr in traces])
+                offsets = num.zeros(len(traces), dtype=num.int32)
+
+        if traces is None:
+            break
+
+        process_window(
+            ydata, offsets, traces[0].tmin, traces[0].tmax, deltat,
+            shift_table, shifts, bazis, slownesses, npad, lengthout,
+            method=method, highpass=highpass, lowpass=lowpass,
+            want_frames=False, impl=impl, timer=timer, **kwargs)
+
+    return timer
+
+
+def benchmark_sweep(nstations=(8, 16, 32), delta_bazis=(4., 2.),
+                    tincs=(30., 60.), impls=('openmp',), **kwargs):
+    '''
+    Run :py:func:`benchmark` for all combinations of station count, grid
+    density, window length and parstack implementation and print wall time
+    [s] and peak memory [MB] of each stage.
+
+    Peak memory is traced with :py:mod:`tracemalloc` if available.
+    '''
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    print('%5s %7s %7s %7s  ' % ('nsta', 'ngrid', 'tinc', 'impl') +
+          ' '.join('%16s' % stage for stage in BENCHMARK_STAGES))
+
+    for nsta in nstations:
+        for delta_bazi in delta_bazis:
+            for tinc in tincs:
+                for impl in impls:
+                    timer = benchmark(
+                        nsta, delta_bazi, tinc, impl=impl, **kwargs)
+
+                    ngrid = len(num.arange(0., 360.+delta_bazi, delta_bazi))
+                    ngrid *= len(num.arange(
+                        kwargs.get('slowness_min', 0.01),
+                        kwargs.get('slowness_max', 0.2),
+                        kwargs.get('slowness_delta', 0.002)))
+
+                    print('%5i %7i %7.1f %7s  ' % (nsta, ngrid, tinc, impl) +
+                          ' '.join(
+                              '%7.3fs %6.1fM' % (
+                                  timer.stages[stage][0],
+                                  timer.stages[stage][1] / 1024.**2)
+                              for stage in BENCHMARK_STAGES))
 
 
 class FK(Snuffling):
@@ -175,7 +1832,11 @@ class FK(Snuffling):
     <body>
     <h1 align='center'>FK ANALYSIS</h1>
     <p>
-    Performs delay and sum in the time domain.
+    Performs delay and sum in the time domain (methods <b>stack</b> and
+    <b>correlate</b>) or evaluates f-k power of the cross-spectral matrix
+    within the viewer's filter band in sliding windows of <b>f-k window
+    length</b> (method <b>frequency domain</b>). The latter is usually faster
+    for long windows and coarse grids.
     <u>Usage</u><br>
 
      - Load station information at startup <br>
@@ -195,9 +1856,84 @@ class FK(Snuffling):
     slowness/back-azimuth the other two coherence maps are generated which
     show the coherence in the slowness and back-azimuth domain for that
     specific maximum of that processing block.<br>
-
+    The array response function (ARF) of the station geometry on the same
+    grid is shown next to the polar plot. It is evaluated in the band of the
+    viewer's filter settings and only recomputed when the stations or the
+    grid change.
+    <p>
+    In <b>Streaming mode</b> no figures are generated. Instead, contiguous
+    windows of <b>Increment</b> length are processed with filter states and
+    overlap carried over between windows, and the maximum power and the
+    corresponding back-azimuth and slowness of each sample are appended to a
+    binary result file. Use <i>load_fk_results</i> to read it.
+    </p>
+    <p>
+    With <b>Worker processes</b> larger than one, windows are processed in
+    a pool of worker processes. Beams and markers at the maximum power of
+    each window are added in time order as soon as results are available.
+    Disable <b>Show</b> to avoid transferring the full coherence maps from
+    the workers.
+    </p>
+    <p>
+    <b>Coarse-to-fine grid search</b> first stacks a grid decimated by
+    <b>Coarse grid decimation</b> in back-azimuth and slowness and refines
+    the grid only around the strongest coarse maxima of each search block.
+    The number of evaluated grid points is printed to the terminal.
+    </p>
+    <p>
+    <b>Memory-bounded reduction</b> stacks the grid in chunks and keeps only
+    the maximum over the grid of each sample and the maximum over time of
+    each grid point. Use it for fine grids and long windows. Coherence maps
+    and the polar movie are not available in this mode.
+    </p>
+    <p>
+    With <b>Fractional delays</b> the <b>stack</b> method and the beam use
+    windowed-sinc interpolation instead of rounding delays to full samples.
+    This resolves slowness differences smaller than one sample of moveout
+    without upsampling the data, at the cost of six stacking passes. The
+    <b>frequency domain</b> method always uses exact delays.
+    </p>
+    <p>
+    The <b>Detector</b> runs on the maximum beam power of each sample, either
+    as recursive <b>STA</b>/<b>LTA</b> ratio or directly as threshold. A
+    marker is added wherever the detector rises above <b>Trigger on</b>. It
+    is labelled with back-azimuth [deg] and slowness [s/km] at the maximum
+    beam power until the detector falls below <b>Trigger off</b> and is
+    armed again. Detector state is carried over between contiguous windows,
+    also in streaming mode.
+    </p>
+    <p>
+    With <b>Subarrays</b> set to <i>network</i>, stations of each network are
+    processed as a separate array with its own center station and detector,
+    in <b>Worker processes</b> if more than one is selected. A
+    <b>Detector</b> is required in this mode. Each subarray gets a beam, a
+    marker at its maximum power and markers of its detections. The
+    back-azimuths of the strongest detections of all subarrays in a window
+    are intersected on a grid of <b>Location grid radius</b> around the
+    arrays. The best location is added as an event marker.
+    </p>
+    <p>
+    Traces with differing sampling rates are resampled to the lowest
+    sampling rate in the dataset with polyphase filtering. Resampled windows
+    are cached, so that repeated runs do not resample again.
+    </p>
+    <p>
+    <b>Save polar movies</b> renders the polar coherence movie of every
+    processing window to an animated GIF file of at most 100 frames, without
+    requiring a display or external encoders. The filename template may
+    contain <i>%(tmin)s</i>, <i>.gif</i> is appended if missing. Rendering
+    takes a few seconds per window, during which Snuffler does not respond.
+    Use <i>save_polar_movie</i> for batch processing.
+    </p>
+    <p>
+    <b>Phase weighted stack</b> adds a continuous beam weighted by the
+    coherence of the instantaneous phases (channel PWS).
+    </p>
     Picinbono, et. al, 1997, On Instantaneous Amplitude and Phase of Signals,
-    552 IEEE TRANSACTIONS ON SIGNAL PROCESSING, 45, 3, March 1997
+    552 IEEE TRANSACTIONS ON SIGNAL PROCESSING, 45, 3, March 1997<br>
+    Schimmel, M. and Paulssen, H., 1997, Noise reduction and detection of weak,
+    coherent signals through phase-weighted stacks, Geophys. J. Int., 130,
+    497-505
     </body>
     </html>
     '''
@@ -222,14 +1958,45 @@ class FK(Snuffling):
         self.add_parameter(Choice(
             'Use channels', 'want_channel', '*',
             ['*', '*Z', '*E', '*N', 'SHZ', 'BHZ', 'p0']))
-        self.add_parameter(
-            Choice('method', 'method', 'stack', ['stack', 'correlate'])
-        )
+        self.add_parameter(Choice(
+            'method', 'method', 'stack',
+            ['stack', 'correlate', 'frequency domain']))
+        self.add_parameter(Param(
+            'f-k window length [s]', 'fk_window', 2., 0.1, 30.))
+        self.add_parameter(Param(
+            'Coarse grid decimation', 'coarse_factor', 4, 2, 10))
+        self.add_parameter(Param(
+            'Worker processes', 'nworkers', 1, 1, 64))
+        self.add_parameter(Switch(
+            'Coarse-to-fine grid search', 'want_hierarchical', False))
+        self.add_parameter(Switch(
+            'Memory-bounded reduction', 'want_reduce', False))
+        self.add_parameter(Switch(
+            'Fractional delays', 'want_fractional', False))
         self.add_parameter(Switch('Show', 'want_all', True))
+        self.add_parameter(Switch(
+            'Save polar movies', 'want_movie_export', False))
+        self.add_parameter(Switch(
+            'Streaming mode (save results only)', 'want_streaming', False))
         self.add_parameter(Switch('Phase weighted stack', 'want_pws', False))
+        self.add_parameter(Choice(
+            'Detector', 'detector_method', 'off',
+            ['off', 'sta/lta', 'threshold']))
+        self.add_parameter(Param('STA [s]', 'tsta', 1., 0.1, 60.))
+        self.add_parameter(Param('LTA [s]', 'tlta', 10., 1., 600.))
+        self.add_parameter(Param('Trigger on', 'trigger_on', 3., 0., 100.))
+        self.add_parameter(Param('Trigger off', 'trigger_off', 1.5, 0., 100.))
+        self.add_parameter(Choice(
+            'Subarrays', 'subarray_grouping', 'off', ['off', 'network']))
+        self.add_parameter(Param(
+            'Location grid radius [km]', 'location_radius', 100., 1., 2000.))
         self.set_live_update(False)
         self.irun = 0
         self.figs2draw = []
+        self.shift_tables = ShiftTableCache()
+        self.array_responses = ArrayResponseCache()
+        self.resampled = ResampleCache()
+        self.movies = []
 
     def new_figure(self, title=''):
         '''Return a new Figure instance'''
@@ -248,17 +2015,19 @@ class FK(Snuffling):
     def call(self):
 
         self.cleanup()
-        figs = []
+        self.movies = []
+        self.movie_template = None
+        self.detector = None
+        self.detection_nslc_ids = []
         azi_theo = None
         method = {'stack': 0,
-                  'correlate': 2}[self.method]
+                  'correlate': 2,
+                  'frequency domain': None}[self.method]
 
         bazis = num.arange(0., 360.+self.delta_bazi, self.delta_bazi)
         slownesses = num.arange(self.slowness_min/km,
                                 self.slowness_max/km,
                                 self.slowness_delta/km)
-        n_bazis = len(bazis)
-        n_slow = len(slownesses)
 
         viewer = self.get_viewer()
         event = viewer.get_active_event()
@@ -268,33 +2037,32 @@ class FK(Snuffling):
                                  stations))
 
         traces_pile = self.get_pile()
-        deltats = traces_pile.deltats.keys()
-        if len(deltats) > 1:
-            self.fail('sampling rates differ in dataset')
-        else:
-            deltat_cf = deltats[0]
+        deltats = list(traces_pile.deltats.keys())
+
+        # mixed sampling rates are resampled to the lowest rate
+        deltat_cf = max(deltats)
+        tpad_resample = get_resample_tpad(deltats, deltat_cf)
+        if tpad_resample:
+            print('resampling traces to %g Hz' % (1./deltat_cf))
 
         tinc_use = self.get_tinc_use(precision=deltat_cf)
 
+        if self.detector_method != 'off':
+            self.detector = self.make_detector(deltat_cf)
+
         if self.ntaper:
             taper = num.hanning(int(self.ntaper))
         else:
             taper = None
 
-        frames = None
         t1 = time.time()
 
         # make sure that only visible stations are used
         use_stations = stations
         center_station = get_center_station(use_stations, select_closest=True)
         print('Center station: ', center_station)
-        shift_table = get_shifts(
-            stations=use_stations,
-            center_station=center_station,
-            bazis=bazis,
-            slownesses=slownesses)
-
-        shifts = num.round(shift_table / deltat_cf).astype(num.int32)
+        shift_table, shifts = self.shift_tables.get(
+            use_stations, center_station, bazis, slownesses, deltat_cf)
 
         # padding from maximum shift of traces:
         npad = num.max(num.abs(shifts))
@@ -307,384 +2075,751 @@ class FK(Snuffling):
         npad += npad_fade
         tpad += tpad_fade
 
-        frames = None
         tinc_add = tinc_use or 0
 
         def trace_selector(x):
             return util.match_nslc('*.*.*.%s' % self.want_channel, x.nslc_id)
 
-        for traces in self.chopper_selected_traces(
-                tinc=tinc_use, tpad=tpad, fallback=True,
-                want_incomplete=False, trace_selector=trace_selector):
+        if self.want_streaming:
+            self.call_streaming(
+                bazis=bazis,
+                slownesses=slownesses,
+                method=method,
+                deltat=deltat_cf,
+                tinc=tinc_use,
+                npad=npad,
+                taper=taper,
+                stations_dict=stations_dict,
+                center_station=center_station,
+                trace_selector=trace_selector,
+                tpad_resample=tpad_resample)
+            return
+
+        if self.subarray_grouping != 'off':
+            self.call_subarrays(
+                bazis=bazis,
+                slownesses=slownesses,
+                method=method,
+                deltat=deltat_cf,
+                tinc=tinc_use,
+                taper=taper,
+                stations_dict=stations_dict,
+                trace_selector=trace_selector,
+                tpad_resample=tpad_resample)
+            return
+
+        if self.want_movie_export and not self.want_reduce:
+            self.movie_template = self.output_filename(
+                caption='Save polar movies (template)',
+                dir='fk_polar_%(tmin)s.gif')
+
+            logger.warning(
+                'Saving polar movies blocks Snuffler for a few seconds per '
+                'window. Use save_polar_movie in a script for long time '
+                'spans.')
+
+        nworkers = int(self.nworkers or 1)
+        pending = deque()
+
+        with worker_pool(nworkers, process_window) as pool:
+            for traces in self.chopper_selected_traces(
+                    tinc=tinc_use, tpad=tpad+tpad_resample, fallback=True,
+                    want_incomplete=False, trace_selector=trace_selector):
+
+                if len(traces) == 0:
+                    self.fail('No traces matched')
+                    continue
+
+                traces = self.resampled.resample(
+                    traces, deltat_cf, tcut=tpad_resample)
+
+                use_stations = []
+                for tr in traces:
+                    try:
+                        use_stations.append(
+                            stations_dict[viewer.station_key(tr)])
+                    except KeyError:
+                        self.fail('no trace %s' % ('.'.join(tr.nslc_id)))
+
+                shift_table, shifts = self.shift_tables.get(
+                    use_stations, center_station, bazis, slownesses,
+                    deltat_cf)
+
+                wmin = traces[0].tmin
+                wmax = wmin + tinc_add
+
+                iwmin = int(round((wmin-wmin) / deltat_cf))
+                iwmax = int(round((wmax-wmin) / deltat_cf))
+                lengthout = iwmax - iwmin
+
+                nsamples = min(tr.data_len() for tr in traces)
+                kwargs = dict(
+                    ydata=num.array(
+                        [tr.get_ydata()[:nsamples] for tr in traces]),
+                    offsets=num.array(
+                        [int(round((tr.tmin-wmin) / deltat_cf))
+                         for tr in traces], dtype=num.int32),
+                    tmin=traces[0].tmin,
+                    tmax=traces[0].tmax,
+                    deltat=deltat_cf,
+                    shift_table=shift_table,
+                    shifts=shifts,
+                    bazis=bazis,
+                    slownesses=slownesses,
+                    npad=npad,
+                    lengthout=lengthout,
+                    offsetout=iwmin,
+                    method=method,
+                    highpass=viewer.highpass,
+                    lowpass=viewer.lowpass,
+                    taper=taper,
+                    fk_window=self.fk_window,
+                    search_factor=self.search_factor,
+                    hierarchical=self.want_hierarchical,
+                    coarse_factor=int(self.coarse_factor),
+                    reduce=self.want_reduce,
+                    fractional=self.want_fractional,
+                    want_pws=self.want_pws,
+                    want_frames=self.want_all or self.want_movie_export)
+
+                arf = None
+                if self.want_all:
+                    arf = self.array_responses.get(
+                        use_stations, center_station, bazis, slownesses,
+                        get_arf_frequencies(
+                            deltat_cf, viewer.highpass, viewer.lowpass))
+
+                # theoretical bazi
+                if event is not None:
+                    azi_theo = get_theoretical_backazimuth(
+                        event, use_stations, center_station)
+                    print('theoretical azimuth %s degrees' % (azi_theo))
+
+                if pool is None:
+                    result = process_window(**kwargs)
+                    print('processing time: %s seconds' % (time.time()-t1))
+                    self.add_window_result(
+                        result, kwargs, tpad=tpad, azi_theo=azi_theo,
+                        arf=arf)
+                    continue
+
+                kwargs['nparallel'] = 1
+                pending.append((
+                    kwargs, azi_theo, arf,
+                    pool.apply_async(process_window, kwds=kwargs)))
+
+                # add results in time order as soon as they are available
+                while pending and (
+                        pending[0][-1].ready() or len(pending) > 2*nworkers):
+
+                    kwargs, azi_theo, arf, async_result = pending.popleft()
+                    self.add_window_result(
+                        async_result.get(), kwargs, tpad=tpad,
+                        azi_theo=azi_theo, arf=arf)
+
+            while pending:
+                kwargs, azi_theo, arf, async_result = pending.popleft()
+                self.add_window_result(
+                    async_result.get(), kwargs, tpad=tpad, azi_theo=azi_theo,
+                    arf=arf)
+
+            self.flush_detections()
+
+            if pool is not None:
+                print('processing time: %s seconds' % (time.time()-t1))
+
+    def add_window_result(self, result, kwargs, tpad, azi_theo=None,
+                          arf=None):
+        '''
+        Add beam and maximum marker of a processed window to the viewer and
+        generate figures.
+
+        :param result: dict returned by :py:func:`process_window`
+        :param kwargs: keyword arguments *result* was computed with
+        :param arf: array response on the grid, shown next to the polar plot
+        '''
+        deltat = kwargs['deltat']
+        times = result['times']
+        beam_tr = trace.Trace(
+            tmin=kwargs['tmin']+tpad, ydata=result['stack_trace'],
+            deltat=deltat)
+
+        self.add_trace(beam_tr)
+
+        if 'pws_trace' in result:
+            self.add_trace(trace.Trace(
+                channel='PWS', tmin=kwargs['tmin']+tpad,
+                ydata=result['pws_trace'], deltat=deltat))
+
+        if kwargs['hierarchical']:
+            print('evaluated %i of %i grid points' % (
+                result['nevaluated'],
+                len(kwargs['bazis'])*len(kwargs['slownesses'])))
+
+        imax_time = num.argmax(result['max_powers'])
+        tmax_power = kwargs['tmin'] + imax_time*deltat
+        self.add_marker(PhaseMarker(
+            [beam_tr.nslc_id], tmax_power, tmax_power,
+            kind=1, phasename='%.0f/%.3f' % (
+                result['bazi'][imax_time], result['slow'][imax_time])))
+
+        self.add_detections(
+            kwargs['tmin'], deltat, result['max_powers'], result['bazi'],
+            result['slow'], [beam_tr.nslc_id])
+
+        if self.movie_template and result.get('frames') is not None:
+            fn = self.movie_template % dict(
+                tmin=util.time_to_str(
+                    kwargs['tmin'], format='%Y-%m-%d_%H-%M-%S'))
+
+            t_movie = time.time()
+            fn = save_polar_movie(
+                fn, result['frames'], times, kwargs['bazis'],
+                kwargs['slownesses'])
+
+            print('polar movie saved to %s in %.1f seconds' % (
+                fn, time.time()-t_movie))
+
+        if self.want_all:
+            self.plot_window(result, kwargs, azi_theo=azi_theo, arf=arf)
+            self.draw_figures()
+            self.irun += 1
+
+    def plot_window(self, result, kwargs, azi_theo=None, arf=None):
+        '''
+        Generate figures of a window processed with *want_frames* enabled.
+
+        Coherence maps and the polar movie are skipped if the full frames
+        are not available.
+        '''
+        frames = result['frames']
+        arrays = result['arrays']
+        max_powers = result['max_powers']
+        best_frame = result['grid_max']
+        times = result['times']
+        stack_trace = result['stack_trace']
+        block_max_times = result['block_max_times']
+        local_max_bazi = result['local_max_bazi']
+        local_max_slow = result['local_max_slow']
+        bazi_fitted = result['bazi_fitted']
+        slow_fitted = result['slow_fitted']
+
+        bazis = kwargs['bazis']
+        slownesses = kwargs['slownesses']
+        shifts = kwargs['shifts']
+        npad = kwargs['npad']
+        lengthout = kwargs['lengthout']
+        n_bazis = len(bazis)
+        n_slow = len(slownesses)
+
+        # ---------------------------------------------------------
+        # maxima search
+        # ---------------------------------------------------------
+        fig1 = self.new_figure('Max Power')
+        nsubplots = 1
+        ax = fig1.add_subplot(nsubplots, 1, 1)
+        ax.plot(max_powers)
+        # --------------------------------------------------------------
+        # coherence maps
+        # --------------------------------------------------------------
+
+        imax_time = num.argmax(max_powers)
+        imax_bazi_slow = num.argmax(best_frame)
+        imax_bazi, imax_slow = num.unravel_index(
+            num.argmax(best_frame),
+            (n_bazis, n_slow))
+
+        if frames is not None:
+            frames_reshaped = frames.reshape((n_bazis, n_slow, lengthout))
+
+            fig2 = self.new_figure('Slowness')
+            data = frames_reshaped[imax_bazi, :, :]
+            data_max = num.amax(frames_reshaped, axis=0)
 
-            if len(traces) == 0:
-                self.fail('No traces matched')
-                continue
+            ax = fig2.add_subplot(211)
+            ax.set_title('Global maximum slize')
+            ax.set_ylabel('slowness [s/km]')
+            ax.plot(times[imax_time], slownesses[imax_slow]*km, 'b.')
+            ax.pcolormesh(times, slownesses*km, data)
 
-            # should be correct
-            t_min = traces[0].tmin
-            t_max = traces[0].tmax
+            ax = fig2.add_subplot(212, sharex=ax, sharey=ax)
+            ax.set_ylabel('slowness [s/km]')
+            ax.pcolormesh(times, slownesses*km, data_max)
+            ax.set_title('Maximum')
 
-            use_stations = []
-            for tr in traces:
-                try:
-                    use_stations.append(stations_dict[viewer.station_key(tr)])
-                except KeyError:
-                    self.fail('no trace %s' % ('.'.join(tr.nslc_id)))
+            # highlight block maxima
+            ax.plot(block_max_times, local_max_slow, 'wo')
 
-            shift_table = get_shifts(
-                stations=use_stations,
-                center_station=center_station,
+            ax.plot(times, num.clip(
+                slow_fitted, self.slowness_min, self.slowness_max)
+            )
+
+            fig3 = self.new_figure('Back-Azimuth')
+            data = frames_reshaped[:, imax_slow, :]
+            data_max = num.amax(frames_reshaped, axis=1)
+
+            ax = fig3.add_subplot(211, sharex=ax)
+            ax.set_title('Global maximum slize')
+            ax.set_ylabel('back-azimuth')
+            ax.pcolormesh(times, bazis, data)
+            ax.plot(times[imax_time], bazis[imax_bazi], 'b.')
+
+            ax = fig3.add_subplot(212, sharex=ax, sharey=ax)
+            ax.set_ylabel('back-azimuth')
+            ax.set_title('Maximum')
+            ax.pcolormesh(times, bazis, data_max)
+
+            # highlight block maxima
+            ax.plot(block_max_times, local_max_bazi, 'wo')
+            ax.plot(times, num.clip(bazi_fitted, 0, 360.))
+
+        # xfmt = md.DateFormatter('%Y-%m-%d %H:%M:%S')
+        # ax.xaxis.set_major_formatter(xfmt)
+        # fig.autofmt_xdate()
+        # fig.subplots_adjust(hspace=0)
+
+        semblance = best_frame.reshape((n_bazis, n_slow))
+
+        fig4 = self.new_figure('Max')
+        theta, r = num.meshgrid(bazis, slownesses)
+        theta *= (num.pi/180.)
+
+        ncols = 1 if arf is None else 2
+        ax = fig4.add_subplot(1, ncols, 1, projection='polar')
+        m = ax.pcolormesh(theta.T, r.T*km, to_db(semblance))
+
+        ax.plot(bazis[imax_bazi]*d2r, slownesses[imax_slow]*km, 'o')
+
+        bazi_max = bazis[imax_bazi]*d2r
+        slow_max = slownesses[imax_slow]*km
+        ax.plot(bazi_max, slow_max, 'b.')
+        ax.text(0.5, 0.01, 'Maximum at %s degrees, %s s/km' %
+                (num.round(bazi_max, 1), slow_max),
+                transform=fig4.transFigure,
+                horizontalalignment='center',
+                verticalalignment='bottom')
+
+        if azi_theo:
+            ax.arrow(azi_theo/180.*num.pi, num.min(slownesses), 0,
+                     num.max(slownesses), alpha=0.5, width=0.015,
+                     edgecolor='black', facecolor='green', lw=2,
+                     zorder=5)
+
+        self.adjust_polar_axis(ax)
+        fig4.colorbar(m, ax=ax)
+
+        if arf is not None:
+            ax_arf = fig4.add_subplot(1, ncols, 2, projection='polar')
+            m = ax_arf.pcolormesh(theta.T, r.T*km, arf, vmin=0., vmax=1.)
+            ax_arf.set_title('Array response')
+            self.adjust_polar_axis(ax_arf)
+            fig4.colorbar(m, ax=ax_arf)
+
+        # ---------------------------------------------------------
+        # CF and beam forming
+        # ---------------------------------------------------------
+        fig5 = self.new_figure('Beam')
+        nsubplots = 4
+        nsubplots += self.want_pws
+
+        ax_raw = fig5.add_subplot(nsubplots, 1, 1)
+        ax_shifted = fig5.add_subplot(nsubplots, 1, 2)
+        ax_beam = fig5.add_subplot(nsubplots, 1, 3)
+        ax_beam_new = fig5.add_subplot(nsubplots, 1, 4)
+
+        axkwargs = dict(alpha=0.3, linewidth=0.3, color='grey')
+
+        # traces aligned along the global maximum
+        arrays = num.asarray(arrays)
+        isorting = num.clip(
+            num.arange(lengthout)[num.newaxis, :] + npad
+            - shifts[imax_bazi_slow][:, num.newaxis],
+            0, arrays.shape[1]-1)
+        itraces = num.arange(arrays.shape[0])[:, num.newaxis]
+        arrays_shifted = arrays[itraces, isorting]
+        ydata_shifted = kwargs['ydata'][itraces, isorting]
+        ybeam = num.sum(ydata_shifted, axis=0)
+
+        for array, array_shifted in zip(arrays, arrays_shifted):
+            ax_raw.plot(times, array[npad: -npad], **axkwargs)
+            ax_shifted.plot(times, array_shifted, **axkwargs)
+
+        ax_beam_new.plot(stack_trace)
+        ax_beam_new.set_title('continuous mode')
+        # ax_beam.plot(times, ybeam, color='black')
+        ax_beam.plot(ybeam, color='black')
+        ax_raw.set_title('Characteristic Function')
+        ax_shifted.set_title('Shifted CF')
+        ax_beam.set_title('Linear Stack')
+
+        if self.want_pws:
+            ax_playground = fig5.add_subplot(nsubplots, 1, 5)
+            ax_playground.plot(phase_weighted_stack(ydata_shifted))
+            ax_playground.set_title('Phase Weighted Stack')
+
+        # -----------------------------------------------------------
+        # polar movie:
+        # -----------------------------------------------------------
+        if frames is not None:
+            fig6 = self.new_figure('Beam')
+            self.polar_movie(
+                fig=fig6,
+                frames=frames,
+                times=times,
                 bazis=bazis,
                 slownesses=slownesses)
 
-            shifts = num.round(shift_table / deltat_cf).astype(num.int32)
+    def call_streaming(self, bazis, slownesses, method, deltat, tinc, npad,
+                       taper, stations_dict, center_station, trace_selector,
+                       tpad_resample=0.):
+        '''
+        Process contiguous windows and append per-sample maximum power,
+        back-azimuth and slowness to a result file.
 
-            wmin = traces[0].tmin
-            wmax = wmin + tinc_add
+        Traces not sampled at *deltat* are resampled with a margin of
+        *tpad_resample* seconds, which is cut off afterwards.
+        '''
+        viewer = self.get_viewer()
+        fn = self.output_filename(
+            caption='Save FK result series', dir='fk_results.bin')
 
-            iwmin = int(round((wmin-wmin) / deltat_cf))
-            iwmax = int(round((wmax-wmin) / deltat_cf))
-            lengthout = iwmax - iwmin
-            arrays = num.zeros((len(traces), lengthout + npad*2))
+        n_slow = len(slownesses)
+        writer = FKResultWriter(fn)
+        stream = None
+        nsamples_total = 0
+        ndetections = 0
+        t1 = time.time()
 
-            for itr, tr in enumerate(traces):
-                tr = tr.copy()
-                if viewer.highpass:
-                    tr.highpass(4, viewer.highpass, demean=True)
-                else:
-                    tr.ydata = num.asarray(
-                        tr.ydata, dtype=num.float) - num.mean(tr.ydata)
-                if viewer.lowpass:
-                    tr.lowpass(4, viewer.lowpass)
+        try:
+            for traces in self.chopper_selected_traces(
+                    tinc=tinc, tpad=tpad_resample, fallback=True,
+                    want_incomplete=False, trace_selector=trace_selector):
+
+                if len(traces) == 0:
+                    continue
+
+                traces = self.resampled.resample(
+                    traces, deltat, tcut=tpad_resample)
+
+                traces.sort(key=lambda tr: tr.nslc_id)
+
+                if stream is None or not stream.matches(traces):
+                    use_stations = []
+                    for tr in traces:
+                        try:
+                            use_stations.append(
+                                stations_dict[viewer.station_key(tr)])
+                        except KeyError:
+                            self.fail('no trace %s' % ('.'.join(tr.nslc_id)))
+
+                    shift_table, shifts = self.shift_tables.get(
+                        use_stations, center_station, bazis, slownesses,
+                        deltat)
 
-                arrays[itr] = tr.get_ydata()
+                    stream = StreamBuffer(
+                        [tr.nslc_id for tr in traces], deltat,
+                        noverlap=2*npad,
+                        highpass=viewer.highpass,
+                        lowpass=viewer.lowpass)
 
-            # if viewer.highpass:
-            #     arrays = highpass_array(
-            #            arrays, deltat_cf, 4, viewer.highpass)
-            # if viewer.lowpass:
-            #     arrays = lowpass_array(arrays, deltat_cf, 4, viewer.lowpass)
+                tmin, data = stream.push(traces)
+                lengthout = data.shape[1] - 2*npad
+                if lengthout <= 0:
+                    continue
 
-            _arrays = []
-            for itr, tr in enumerate(traces):
                 if taper is not None:
-                    ydata = fftconvolve(arrays[itr], taper, mode='same')
+                    data = fftconvolve(
+                        data, taper[num.newaxis, :], mode='same', axes=1)
+
+                stack = make_stacker(
+                    [num.ascontiguousarray(row) for row in data],
+                    num.zeros(len(traces), dtype=num.int32),
+                    shift_table, shifts, deltat, method, lengthout,
+                    offsetout=npad,
+                    fk_window=self.fk_window,
+                    fmin=viewer.highpass,
+                    fmax=viewer.lowpass,
+                    fractional=self.want_fractional)
+
+                if self.want_reduce:
+                    power, imax, _ = reduce_grid(
+                        stack, shifts.shape[0], lengthout)
                 else:
-                    ydata = arrays[itr]
-                _arrays.append(num.asarray(ydata, dtype=num.float64))
-            arrays = _arrays
+                    frames = stack(slice(None))
+                    imax = num.argmax(frames, axis=0)
+                    power = frames[imax, num.arange(lengthout)]
 
-            offsets = num.array(
-                [int(round((tr.tmin-wmin) / deltat_cf)) for tr in traces],
-                dtype=num.int32)
+                writer.write(
+                    tmin + npad*deltat, deltat, power,
+                    bazis[imax // n_slow], slownesses[imax % n_slow]*km)
 
-            ngridpoints = len(bazis)*len(slownesses)
-            weights = num.ones((ngridpoints, len(traces)))
+                ndetections += self.add_detections(
+                    tmin + npad*deltat, deltat, power,
+                    bazis[imax // n_slow], slownesses[imax % n_slow]*km,
+                    [tr.nslc_id for tr in traces])
 
-            frames, ioff = parstack.parstack(
-                arrays, offsets, shifts, weights, method,
-                offsetout=iwmin,
-                lengthout=lengthout,
-                result=frames,
-                impl='openmp')
+                nsamples_total += lengthout
 
-            # theoretical bazi
-            if event is not None:
-                azi_theo = get_theoretical_backazimuth(
-                    event, use_stations, center_station)
-                print('theoretical azimuth %s degrees' % (azi_theo))
+            ndetections += self.flush_detections()
 
-            print('processing time: %s seconds' % (time.time()-t1))
+        finally:
+            writer.close()
 
-            if frames is None:
-                self.fail('Could not process data!')
-                return
+        print('streaming: %i samples written to %s in %s seconds' % (
+            nsamples_total, fn, time.time()-t1))
 
-            frames_reshaped = frames.reshape((n_bazis, n_slow, lengthout))
-            times = num.linspace(t_min-tpad_fade, t_max+tpad_fade, lengthout)
-            max_powers = num.max(frames, axis=0)
+        if self.detector is not None:
+            print('streaming: %i detections' % ndetections)
 
-            # power maxima in blocks
-            i_max_blocked = search_max_block(
-                n_maxsearch=int(npad*self.search_factor), data=max_powers)
+    def call_subarrays(self, bazis, slownesses, method, deltat, tinc, taper,
+                       stations_dict, trace_selector, tpad_resample=0.):
+        '''
+        Process groups of stations as separate arrays and locate the source
+        of each window by intersecting their back-azimuths.
+
+        Every subarray gets its own center station, beam and detector. The
+        back-azimuths and slownesses at the beam power peaks of the strongest
+        detections of the subarrays completed in a window are combined with
+        :py:func:`cross_bearing_location` into an event marker. Its origin
+        time is the mean of the peak times, reduced by the distance to the
+        location times the observed slowness.
+        '''
+        if self.detector is None:
+            self.fail('Subarray processing needs a detector to select the '
+                      'signals to be located.')
 
-            max_powers += (num.min(max_powers)*-1)
-            max_powers /= num.max(max_powers)
-            max_powers *= max_powers
-            weights = max_powers[i_max_blocked]
-            block_max_times = times[i_max_blocked]
+        viewer = self.get_viewer()
 
-            _argmax = num.argmax(frames, axis=0)
-            imax_bazi_all, imax_slow_all = num.unravel_index(
-                _argmax, dims=(n_bazis, n_slow))
+        groups = {}
+        for key, station in stations_dict.items():
+            groups.setdefault(station.network, []).append(station)
 
-            local_max_bazi = bazis[imax_bazi_all][i_max_blocked]
-            local_max_slow = slownesses[imax_slow_all][i_max_blocked]*km
+        centers = dict(
+            (key, get_center_station(group, select_closest=True))
+            for (key, group) in groups.items() if len(group) > 1)
 
-            k_north = num.sin(local_max_bazi * d2r) * local_max_slow
-            k_east = num.cos(local_max_bazi * d2r) * local_max_slow
+        if len(centers) < 2:
+            self.fail('need at least two subarrays with more than one station')
 
-            smooth = 4e7
+        npad = 0
+        for key, center_station in centers.items():
+            _, shifts = self.shift_tables.get(
+                groups[key], center_station, bazis, slownesses, deltat)
+            npad = max(npad, num.max(num.abs(shifts)))
 
-            spline_north = UnivariateSpline(
-                block_max_times, k_north, w=weights,
-                s=smooth
-            )
+        tpad = npad * deltat
+        lengthout = int(round((tinc or 0) / deltat))
 
-            spline_east = UnivariateSpline(
-                block_max_times, k_east, w=weights,
-                s=smooth,
-            )
+        nworkers = min(int(self.nworkers or 1), len(centers))
+        detectors = dict(
+            (key, self.make_detector(deltat)) for key in centers.keys())
 
-            k_north_fit = spline_north(times)
-            k_east_fit = spline_east(times)
+        t1 = time.time()
+        with worker_pool(nworkers, process_window) as pool:
+            for traces in self.chopper_selected_traces(
+                    tinc=tinc, tpad=tpad+tpad_resample, fallback=True,
+                    want_incomplete=False, trace_selector=trace_selector):
+
+                traces = self.resampled.resample(
+                    traces, deltat, tcut=tpad_resample)
+
+                group_traces = {}
+                for tr in traces:
+                    group_traces.setdefault(tr.network, []).append(tr)
+
+                jobs = []
+                for key in sorted(centers.keys()):
+                    trs = group_traces.get(key, [])
+                    if len(trs) < 2:
+                        continue
+
+                    use_stations = []
+                    for tr in trs:
+                        try:
+                            use_stations.append(
+                                stations_dict[viewer.station_key(tr)])
+                        except KeyError:
+                            self.fail('no trace %s' % ('.'.join(tr.nslc_id)))
+
+                    shift_table, shifts = self.shift_tables.get(
+                        use_stations, centers[key], bazis, slownesses, deltat)
+
+                    nsamples = min(tr.data_len() for tr in trs)
+                    kwargs = dict(
+                        ydata=num.array(
+                            [tr.get_ydata()[:nsamples] for tr in trs]),
+                        offsets=num.zeros(len(trs), dtype=num.int32),
+                        tmin=trs[0].tmin,
+                        tmax=trs[0].tmax,
+                        deltat=deltat,
+                        shift_table=shift_table,
+                        shifts=shifts,
+                        bazis=bazis,
+                        slownesses=slownesses,
+                        npad=npad,
+                        lengthout=lengthout,
+                        method=method,
+                        highpass=viewer.highpass,
+                        lowpass=viewer.lowpass,
+                        taper=taper,
+                        fk_window=self.fk_window,
+                        search_factor=self.search_factor,
+                        hierarchical=self.want_hierarchical,
+                        coarse_factor=int(self.coarse_factor),
+                        reduce=self.want_reduce,
+                        fractional=self.want_fractional,
+                        want_frames=False,
+                        nparallel=1)
+
+                    if pool is None:
+                        jobs.append((key, kwargs, process_window(**kwargs)))
+                    else:
+                        jobs.append((key, kwargs, pool.apply_async(
+                            process_window, kwds=kwargs)))
+
+                bearings = []
+                for key, kwargs, job in jobs:
+                    result = job if pool is None else job.get()
+                    beam_tr = trace.Trace(
+                        network=key, station='BEAM',
+                        tmin=kwargs['tmin']+tpad,
+                        ydata=result['stack_trace'], deltat=deltat)
+
+                    self.add_trace(beam_tr)
+
+                    imax_time = num.argmax(result['max_powers'])
+                    tmax_power = kwargs['tmin'] + imax_time*deltat
+                    self.add_marker(PhaseMarker(
+                        [beam_tr.nslc_id], tmax_power, tmax_power, kind=1,
+                        phasename='%.0f/%.3f' % (
+                            result['bazi'][imax_time],
+                            result['slow'][imax_time])))
+
+                    detections = detectors[key].detect_peaks(
+                        kwargs['tmin'], result['max_powers'],
+                        num.column_stack((
+                            result['bazi'], result['slow'],
+                            result['max_powers'])))
+
+                    bearing = self.add_subarray_detections(
+                        centers[key], detections, [beam_tr.nslc_id])
+
+                    if bearing is not None:
+                        bearings.append(bearing)
+
+                self.add_cross_bearing_location(bearings)
+
+            bearings = []
+            for key in sorted(centers.keys()):
+                bearing = self.add_subarray_detections(
+                    centers[key], detectors[key].flush(),
+                    [(key, 'BEAM', '', '')])
+
+                if bearing is not None:
+                    bearings.append(bearing)
+
+            self.add_cross_bearing_location(bearings)
+
+        print('subarray processing time: %s seconds' % (time.time()-t1))
+
+    def add_subarray_detections(self, center, detections, nslc_ids):
+        '''
+        Add markers of the detections of a subarray.
 
-            bazi_fitted = num.arctan2(k_east_fit, k_north_fit) / d2r
-            bazi_fitted -= 90.
-            bazi_fitted *= -1.
-            bazi_fitted[num.where(bazi_fitted<0.)] += 360.
+        :returns: bearing ``(center, bazi, slow, tpeak)`` of the strongest
+            detection or ``None``
+        '''
+        if not detections:
+            return None
 
-            spline_slow = UnivariateSpline(
-                block_max_times,
-                local_max_slow,
-                w=weights,
-            )
+        self.add_detection_markers(detections, nslc_ids)
+        _, tpeak, (bazi, slow, _) = max(
+            detections, key=lambda detection: detection[2][2])
 
-            slow_fitted = spline_slow(times)
-            i_bazi_fitted = value_to_index(
-                bazi_fitted, 0., 360., self.delta_bazi)
+        return center, bazi, slow, tpeak
 
-            i_slow_fitted = value_to_index(
-                slow_fitted, self.slowness_min, self.slowness_max,
-                self.slowness_delta)
+    def add_cross_bearing_location(self, bearings):
+        '''
+        Locate the source of a signal detected by several subarrays and add
+        an event marker.
+        '''
+        if len(bearings) < 2:
+            return
 
-            i_shift = num.ravel_multi_index(
-                num.vstack((i_bazi_fitted, i_slow_fitted)),
-                (n_bazis, n_slow),
-            )
+        array_centers, bazis_obs, slows_obs, times_obs = zip(*bearings)
 
-            stack_trace = num.zeros(lengthout)
-            i_base = num.arange(lengthout, dtype=num.int) + npad
-            for itr, tr in enumerate(traces):
-                isorting = num.clip(
-                    i_base-shifts[i_shift, itr], npad, lengthout+npad)
-                stack_trace += tr.ydata[isorting]
-
-            beam_tr = trace.Trace(
-                tmin=t_min+tpad, ydata=stack_trace, deltat=deltat_cf)
-
-            self.add_trace(beam_tr)
-
-            if self.want_all:
-
-                # ---------------------------------------------------------
-                # maxima search
-                # ---------------------------------------------------------
-                fig1 = self.new_figure('Max Power')
-                nsubplots = 1
-                ax = fig1.add_subplot(nsubplots, 1, 1)
-                ax.plot(num.max(frames, axis=0))
-                # --------------------------------------------------------------
-                # coherence maps
-                # --------------------------------------------------------------
-
-                max_time = num.amax(frames, axis=0)
-                imax_time = num.argmax(max_time)
-                best_frame = num.amax(frames, axis=1)
-                imax_bazi_slow = num.argmax(best_frame)
-                imax_bazi, imax_slow = num.unravel_index(
-                    num.argmax(best_frame),
-                    dims=(n_bazis, n_slow))
-
-                fig2 = self.new_figure('Slowness')
-                data = frames_reshaped[imax_bazi, :, :]
-                data_max = num.amax(frames_reshaped, axis=0)
-
-                ax = fig2.add_subplot(211)
-                ax.set_title('Global maximum slize')
-                ax.set_ylabel('slowness [s/km]')
-                ax.plot(times[imax_time], slownesses[imax_slow]*km, 'b.')
-                ax.pcolormesh(times, slownesses*km, data)
-
-                ax = fig2.add_subplot(212, sharex=ax, sharey=ax)
-                ax.set_ylabel('slowness [s/km]')
-                ax.pcolormesh(times, slownesses*km, data_max)
-                ax.set_title('Maximum')
-
-                # highlight block maxima
-                ax.plot(block_max_times, local_max_slow, 'wo')
-
-                ax.plot(times, num.clip(
-                    slow_fitted, self.slowness_min, self.slowness_max)
-                )
-
-                fig3 = self.new_figure('Back-Azimuth')
-                data = frames_reshaped[:, imax_slow, :]
-                data_max = num.amax(frames_reshaped, axis=1)
-
-                ax = fig3.add_subplot(211, sharex=ax)
-                ax.set_title('Global maximum slize')
-                ax.set_ylabel('back-azimuth')
-                ax.pcolormesh(times, bazis, data)
-                ax.plot(times[imax_time], bazis[imax_bazi], 'b.')
-
-                ax = fig3.add_subplot(212, sharex=ax, sharey=ax)
-                ax.set_ylabel('back-azimuth')
-                ax.set_title('Maximum')
-                ax.pcolormesh(times, bazis, data_max)
-
-                # highlight block maxima
-                ax.plot(block_max_times, local_max_bazi, 'wo')
-                ax.plot(times, num.clip(bazi_fitted, 0, 360.))
-
-                # xfmt = md.DateFormatter('%Y-%m-%d %H:%M:%S')
-                # ax.xaxis.set_major_formatter(xfmt)
-                # fig.autofmt_xdate()
-                # fig.subplots_adjust(hspace=0)
-
-                semblance = best_frame.reshape((n_bazis, n_slow))
-
-                fig4 = self.new_figure('Max')
-                theta, r = num.meshgrid(bazis, slownesses)
-                theta *= (num.pi/180.)
-
-                ax = fig4.add_subplot(111, projection='polar')
-                m = ax.pcolormesh(theta.T, r.T*km, to_db(semblance))
-
-                ax.plot(bazis[imax_bazi]*d2r, slownesses[imax_slow]*km, 'o')
-
-                bazi_max = bazis[imax_bazi]*d2r
-                slow_max = slownesses[imax_slow]*km
-                ax.plot(bazi_max, slow_max, 'b.')
-                ax.text(0.5, 0.01, 'Maximum at %s degrees, %s s/km' %
-                        (num.round(bazi_max, 1), slow_max),
-                        transform=fig4.transFigure,
-                        horizontalalignment='center',
-                        verticalalignment='bottom')
-
-                if azi_theo:
-                    ax.arrow(azi_theo/180.*num.pi, num.min(slownesses), 0,
-                             num.max(slownesses), alpha=0.5, width=0.015,
-                             edgecolor='black', facecolor='green', lw=2,
-                             zorder=5)
-
-                self.adjust_polar_axis(ax)
-                fig4.colorbar(m)
-
-                # ---------------------------------------------------------
-                # CF and beam forming
-                # ---------------------------------------------------------
-                fig5 = self.new_figure('Beam')
-                nsubplots = 4
-                nsubplots += self.want_pws
-
-                ax_raw = fig5.add_subplot(nsubplots, 1, 1)
-                ax_shifted = fig5.add_subplot(nsubplots, 1, 2)
-                ax_beam = fig5.add_subplot(nsubplots, 1, 3)
-                ax_beam_new = fig5.add_subplot(nsubplots, 1, 4)
-
-                axkwargs = dict(alpha=0.3, linewidth=0.3, color='grey')
-
-                ybeam = num.zeros(lengthout)
-                ybeam_weighted = num.zeros(lengthout)
-                for i, (shift, array) in enumerate(zip(shifts.T, arrays)):
-                    ax_raw.plot(times, array[npad: -npad], **axkwargs)
-                    ishift = shift[imax_bazi_slow]
-                    ax_shifted.plot(
-                        times, array[npad-ishift: -npad-ishift], **axkwargs)
-
-                    ydata = traces[i].get_ydata()[npad-ishift: -npad-ishift]
-                    ybeam += ydata
-
-                    # calculate phase weighting
-                    if self.want_pws:
-                        ph_inst = instantaneous_phase(ydata)
-                        ybeam_weighted += num.abs(num.exp(ph_inst))**4
-
-                ax_beam_new.plot(stack_trace)
-                ax_beam_new.set_title('continuous mode')
-                # ax_beam.plot(times, ybeam, color='black')
-                ax_beam.plot(ybeam, color='black')
-                ax_raw.set_title('Characteristic Function')
-                ax_shifted.set_title('Shifted CF')
-                ax_beam.set_title('Linear Stack')
-
-                if self.want_pws:
-                    ax_playground = fig5.add_subplot(nsubplots, 1, 5)
-                    ax_playground.plot(ybeam*ybeam_weighted/len(arrays))
-                    ax_playground.set_title('Phase Weighted Stack')
-
-                # -----------------------------------------------------------
-                # polar movie:
-                # -----------------------------------------------------------
-                fig6 = self.new_figure('Beam')
-                self.polar_movie(
-                    fig=fig6,
-                    frames=frames,
-                    times=times,
-                    theta=theta.T,
-                    r=r.T*km,
-                    nth_frame=2,
-                    n_bazis=n_bazis,
-                    n_slow=n_slow,
-                )
-
-                self.draw_figures()
-
-                self.irun += 1
-
-    def polar_movie(self, fig, frames, times, theta, r, nth_frame,
-                    n_bazis, n_slow):
-        frame_artists = []
-        # progress_artists = []
-        ax = fig.add_subplot(111, projection='polar')
-        iframe_min = 0
-        iframe_max = len(times)-1
-        vmin = num.min(frames)
-        vmax = num.max(frames)
-        self.adjust_polar_axis(ax)
+        lat, lon, misfit = cross_bearing_location(
+            [c.lat for c in array_centers],
+            [c.lon for c in array_centers],
+            bazis_obs, radius=self.location_radius*km)
 
-        def update(iframe):
-            # if iframe is not None:
-            if False:
-                frame = frames[:, iframe]
-                '''
-                if not progress_artists:
-                    progress_artists[:] = [axes2.axvline(
-                        tmin_frames - t0 + deltat_cf * iframe,
-                        color=scolor('scarletred3'),
-                        alpha=0.5,
-                        lw=2.)]
+        dists = ortho.distance_accurate50m_numpy(
+            lat, lon,
+            num.array([c.lat for c in array_centers]),
+            num.array([c.lon for c in array_centers]))
+
+        event = model.Event(
+            lat=lat, lon=lon,
+            time=num.mean(
+                num.array(times_obs) -
+                dists/km * num.array(slows_obs)),
+            name='cross-bearing %.1f deg' % misfit)
+
+        self.add_marker(EventMarker(event))
+        print('cross-bearing location: %.4f, %.4f (misfit %.1f deg)'
+              % (lat, lon, misfit))
+
+    def make_detector(self, deltat):
+        return BeamPowerDetector(
+            deltat, method=self.detector_method, tsta=self.tsta,
+            tlta=self.tlta, threshold_on=self.trigger_on,
+            threshold_off=self.trigger_off)
+
+    def add_detections(self, tmin, deltat, power, bazi, slow, nslc_ids):
+        '''
+        Run the detector on the next chunk of maximum power and add a marker
+        at the trigger onset of each completed detection, labelled with the
+        back-azimuth/slowness at the maximum power of the detection.
 
-                else:
-                    progress_artists[0].set_xdata(
-                        tmin_frames - t0 + deltat_cf * iframe)
-                '''
-            else:
-                frame = frames[:, iframe].reshape((n_bazis, n_slow))
+        :returns: number of detections
+        '''
+        if self.detector is None:
+            return 0
 
-            frame_artists[:] = [ax.pcolormesh(theta, r, frame, vmin=vmin,
-                                              vmax=vmax)]
+        self.detection_nslc_ids = nslc_ids
+        return self.add_detection_markers(
+            self.detector.detect_peaks(
+                tmin, power, num.column_stack((bazi, slow))),
+            nslc_ids)
 
-            # return frame_artists + progress_artists + static_artists
-            return frame_artists
+    def flush_detections(self):
+        '''
+        Add the marker of a detection whose trigger is still on.
 
-        axf = FuncAnimation(  # noqa
-            fig, update,
-            frames=list(
-                range(iframe_min, iframe_max+1))[::nth_frame] + [None],
-            interval=20.,
-            repeat=False,
-            blit=True)
+        :returns: number of detections
+        '''
+        if self.detector is None:
+            return 0
+
+        return self.add_detection_markers(
+            self.detector.flush(), self.detection_nslc_ids)
+
+    def add_detection_markers(self, detections, nslc_ids):
+        self.add_markers([PhaseMarker(
+            nslc_ids, tonset, tonset, kind=2,
+            phasename='%.0f/%.3f' % tuple(value[:2]))
+            for (tonset, _, value) in detections])
+
+        return len(detections)
+
+    def polar_movie(self, fig, frames, times, bazis, slownesses):
+        self.movies.append(make_polar_movie(
+            fig, frames, times, bazis, slownesses))
 
         fig.canvas.draw()
 
     def adjust_polar_axis(self, ax):
-        ax.set_theta_zero_location('N')
-        ax.set_theta_direction(-1)
-        ax.set_xticks([0, num.pi/2., num.pi, 3*num.pi/2])
-        ax.set_xticklabels(['N', 'E', 'S', 'W'])
+        adjust_polar_axis(ax)
 
     def get_tinc_use(self, precision=1.):
         '''
@@ -703,3 +2838,60 @@ class FK(Snuffling):
 
 def __snufflings__():
     return [FK()]
+
+
+if __name__ == '__main__':
+    import optparse
+
+    def floats(option, opt, value, parser):
+        setattr(parser.values, option.dest,
+                [float(x) for x in value.split(',')])
+
+    parser = optparse.OptionParser(
+        usage='usage: %prog [options]',
+        description='Benchmark the FK processing chain with synthetic '
+                    'plane wave array data.')
+
+    for opt, dest, default, help in [
+            ('--nstations', 'nstations', '8,16,32', 'station counts'),
+            ('--delta-bazi', 'delta_bazis', '4,2', 'back-azimuth spacings'),
+            ('--tinc', 'tincs', '30,60', 'window lengths [s]')]:
+
+        parser.add_option(
+            opt, dest=dest, type='string', action='callback', callback=floats,
+            default=[float(x) for x in default.split(',')],
+            help='comma separated list of %s (default=%s)' % (help, default))
+
+    parser.add_option(
+        '--impl', dest='impls', default='openmp',
+        help='comma separated list of parstack implementations '
+             '(default=openmp)')
+    parser.add_option(
+        '--deltat', dest='deltat', type='float', default=0.01,
+        help='sampling interval [s] (default=0.01)')
+    parser.add_option(
+        '--noise', dest='noise', type='float', default=0.1,
+        help='noise level relative to the signal (default=0.1)')
+    parser.add_option(
+        '--layout', dest='layout', default='random',
+        help='station layout: random or ring (default=random)')
+    parser.add_option(
+        '--aperture', dest='aperture', type='float', default=5.,
+        help='array aperture [km] (default=5)')
+    parser.add_option(
+        '--nwindows', dest='nwindows', type='int', default=2,
+        help='number of windows per run (default=2)')
+
+    options, args = parser.parse_args()
+    util.setup_logging('fk_parstack.py', 'warning')
+
+    benchmark_sweep(
+        nstations=[int(x) for x in options.nstations],
+        delta_bazis=options.delta_bazis,
+        tincs=options.tincs,
+        impls=options.impls.split(','),
+        deltat=options.deltat,
+        noise=options.noise,
+        layout=options.layout,
+        aperture=options.aperture*km,
+        nwindows=options.nwindows)
@@ -1,9 +1,41 @@
 from __future__ import print_function
-from pyrocko.gui.snuffling import Param, Snuffling, Choice
+from pyrocko.gui.snuffling import Param, Snuffling, Choice, Switch
+from pyrocko import model
 
+import os
+import sys
 import numpy as num
 
 
+def load_fk_parstack():
+    '''
+    Load the fk_parstack snuffling from the directory of this file.
+
+    Snuffler removes the snufflings directory from :py:data:`sys.path` after
+    loading the snufflings, so the module is loaded from its path.
+    '''
+    import importlib.util
+
+    filename = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'fk_parstack.py')
+
+    spec = importlib.util.spec_from_file_location('fk_parstack', filename)
+    module = importlib.util.module_from_spec(spec)
+
+    # fk_parstack looks itself up in sys.modules while being executed
+    previous = sys.modules.get(spec.name)
+    sys.modules[spec.name] = module
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        if previous is None:
+            del sys.modules[spec.name]
+        else:
+            sys.modules[spec.name] = previous
+
+    return module
+
+
 def p2o_trace(ptrace, station):
     '''Convert Pyrocko trace to ObsPy trace.'''
     from obspy.core import UTCDateTime
@@ -65,6 +97,11 @@ class FK(Snuffling):
     The assumed location of the geometrical center is printed to the terminal.
     </p>
     <p>
+    <b>Show array response</b> plots the array response function of the
+    station geometry on the back-azimuth/slowness bins of the polar plot,
+    evaluated in the band of the viewer's filter settings.
+    </p>
+    <p>
     Further information can be gathered from
     <a href="http://docs.obspy.org/master/tutorial/code_snippets/beamforming_fk_analysis.html">  # noqa
     ObsPy's FK tutorial</a>.
@@ -88,9 +125,12 @@ class FK(Snuffling):
             'If sampling rates differ', 'downresample', 'resample',
             ['resample', 'downsample', 'downsample to "target dt"']))
         self.add_parameter(Param('target dt', 'target_dt', 0.2, 0., 10))
+        self.add_parameter(Switch('Show array response', 'want_arf', False))
 
         # self.add_parameter(Choice('Units: ','unit','[s/km]',('[s/km]','[s/deg]')))  # noqa
         self.set_live_update(False)
+        self.fk_parstack = None
+        self.array_responses = None
 
     def call(self):
         try:
@@ -205,6 +245,48 @@ class FK(Snuffling):
         ColorbarBase(cax, cmap=cmap,
                      norm=Normalize(vmin=hist.min(), vmax=hist.max()))
 
+        if self.want_arf:
+            if self.fk_parstack is None:
+                try:
+                    self.fk_parstack = load_fk_parstack()
+                except (ImportError, OSError) as _import_error:
+                    self.fail(
+                        'Showing the array response requires the '
+                        'fk_parstack snuffling (fk_parstack.py) in %s.\n'
+                        'Error:\n%s' % (
+                            os.path.dirname(os.path.abspath(__file__)),
+                            _import_error))
+
+                self.array_responses = self.fk_parstack.ArrayResponseCache()
+
+            get_arf_frequencies = self.fk_parstack.get_arf_frequencies
+            adjust_polar_axis = self.fk_parstack.adjust_polar_axis
+
+            stations = dict(
+                (viewer.station_key(tr),
+                 viewer.get_station(viewer.station_key(tr)))
+                for tr in traces)
+            stations = [stations[k] for k in sorted(stations.keys())]
+
+            bazis = abins[:-1] + 0.5 * (abins[1] - abins[0])
+            slownesses = sbins[:-1] + 0.5 * (sbins[1] - sbins[0])
+            arf = self.array_responses.get(
+                stations, model.Station(lat=center_lat, lon=center_lon),
+                bazis, slownesses / 1000.,
+                get_arf_frequencies(
+                    traces[0].deltat, viewer.highpass, viewer.lowpass))
+
+            fig_arf = self.pylab(get='figure')
+            ax_arf = fig_arf.add_subplot(111, projection='polar')
+            theta, r = num.meshgrid(bazis / 180. * pi, slownesses)
+            m = ax_arf.pcolormesh(
+                theta.T, r.T, arf, cmap=cmap, vmin=0., vmax=1.)
+            adjust_polar_axis(ax_arf)
+            ax_arf.set_ylim(0., self.smax)
+            ax_arf.set_title('Array response')
+            fig_arf.colorbar(m)
+            fig_arf.canvas.draw()
+
         fig2 = self.pylab(get='figure')
         labels = ['rel.power', 'abs.power', 'baz', 'slow']
         xlocator = mdates.AutoDateLocator()
@@ -0,0 +1,198 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as num
+
+from pyrocko import pile, trace, util
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fk_parstack as fk  # noqa
+
+km = 1000.
+
+
+def ricker_traces(stations, center_station, deltats, tarrival, duration,
+                  bazi=80., slowness=0.07/km, f0=3., noise=0.05, seed=0):
+    '''
+    Ricker wavelet plane wave arriving at *tarrival* at the center station,
+    recorded with sampling intervals *deltats* (one per station).
+    '''
+    rstate = num.random.RandomState(seed)
+    delays = fk.get_shifts(stations, center_station, [bazi], [slowness])[0]
+    traces = []
+    for station, delay, deltat in zip(stations, delays, deltats):
+        t = num.arange(int(round(duration / deltat))) * deltat
+        x = (num.pi * f0 * (t - tarrival + delay))**2
+        ydata = (1. - 2.*x) * num.exp(-x)
+        ydata += rstate.normal(scale=noise, size=t.size)
+        traces.append(trace.Trace(
+            station.network, station.station, '', 'BHZ', tmin=0.,
+            deltat=deltat, ydata=ydata))
+
+    return traces
+
+
+class DummyViewer(object):
+    highpass = 1.
+    lowpass = 5.
+
+    def station_key(self, x):
+        return (x.network, x.station)
+
+    def get_active_event(self):
+        return None
+
+
+class HeadlessFK(fk.FK):
+    '''FK snuffling running on a given pile without a viewer.'''
+
+    def __init__(self, stations, traces_pile, output_filename):
+        fk.FK.__init__(self)
+        self.setup()
+        self._test_stations = stations
+        self._test_pile = traces_pile
+        self._test_output_filename = output_filename
+        self.test_markers = []
+
+    def get_viewer(self):
+        return DummyViewer()
+
+    def get_stations(self):
+        return self._test_stations
+
+    def get_pile(self):
+        return self._test_pile
+
+    def cleanup(self):
+        pass
+
+    def chopper_selected_traces(self, tinc, tpad, fallback, want_incomplete,
+                                trace_selector):
+        p = self._test_pile
+        nwindows = int((p.tmax - p.tmin - 2*tpad) // tinc)
+        return p.chopper(
+            tmin=p.tmin+tpad, tmax=p.tmin+tpad+nwindows*tinc, tinc=tinc,
+            tpad=tpad, want_incomplete=want_incomplete,
+            trace_selector=trace_selector)
+
+    def add_trace(self, tr):
+        pass
+
+    def add_markers(self, markers):
+        self.test_markers.extend(markers)
+
+    def output_filename(self, *args, **kwargs):
+        return self._test_output_filename
+
+
+class FKParstackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_streaming_mixed_sampling_rates(self):
+        tarrival = 50.13
+        stations = fk.synthetic_stations(10, aperture=4*km, seed=3)
+        center_station = fk.get_center_station(stations, select_closest=True)
+
+        # every other station sampled at twice the rate
+        deltats = [0.005 if i % 2 else 0.01 for i in range(len(stations))]
+        traces = ricker_traces(
+            stations, center_station, deltats, tarrival, duration=130.)
+
+        p = pile.Pile()
+        p.add_file(pile.MemTracesFile(None, traces))
+
+        fn = os.path.join(self.tempdir, 'fk_results.bin')
+        snuffling = HeadlessFK(stations, p, fn)
+        snuffling.tinc = 20.
+        snuffling.want_all = False
+        snuffling.want_streaming = True
+        snuffling.detector_method = 'sta/lta'
+        snuffling.call()
+
+        times, power, bazi, slow = fk.load_fk_results(fn)
+
+        # chunks continue each other without gaps or overlaps
+        num.testing.assert_allclose(num.diff(times), 0.01, atol=1e-6)
+        self.assertTrue(times[-1] - times[0] > 100.)
+
+        imax = num.argmax(power)
+        self.assertTrue(abs(times[imax] - tarrival) < 0.1)
+        self.assertTrue(abs(bazi[imax] - 80.) <= 4.)
+        self.assertTrue(abs(slow[imax] - 0.07) <= 0.01)
+
+        detections = [m for m in snuffling.test_markers if m.kind == 2]
+        self.assertEqual(len(detections), 1)
+        self.assertTrue(abs(detections[0].tmin - tarrival) < 0.3)
+
+        bazi_label, slow_label = map(
+            float, detections[0].get_phasename().split('/'))
+        self.assertTrue(abs(bazi_label - 80.) <= 4.)
+        self.assertTrue(abs(slow_label - 0.07) <= 0.01)
+
+    def test_detector_peaks_across_chunks(self):
+        deltat = 0.1
+        power = num.ones(1000)
+        power[300:320] = 10.
+        power[310] = 20.
+        values = num.arange(power.size)
+
+        for nchunk in (1000, 305, 7):
+            detector = fk.BeamPowerDetector(
+                deltat, method='threshold', threshold_on=5.)
+
+            detections = []
+            for i in range(0, power.size, nchunk):
+                detections.extend(detector.detect_peaks(
+                    i*deltat, power[i:i+nchunk], values[i:i+nchunk]))
+
+            detections.extend(detector.flush())
+
+            self.assertEqual(len(detections), 1)
+            tonset, tpeak, value = detections[0]
+            self.assertAlmostEqual(tonset, 30.)
+            self.assertAlmostEqual(tpeak, 31.)
+            self.assertEqual(value, 310)
+
+    def test_worker_pool_after_snuffler_import(self):
+        # Snuffler removes snuffling modules and their directory from
+        # sys.modules and sys.path after importing them
+        dirname = os.path.dirname(os.path.abspath(fk.__file__))
+        sys_path = list(sys.path)
+        del sys.modules[fk.__name__]
+        sys.path[:] = [
+            path for path in sys.path
+            if os.path.abspath(path or os.curdir) != dirname]
+
+        try:
+            with fk.worker_pool(2, fk.value_to_index) as pool:
+                self.assertTrue(pool is not None)
+                indices = pool.apply_async(
+                    fk.value_to_index, (num.array([1.6, 20.]), 0., 10., 1.))
+
+                indices = indices.get(timeout=60)
+
+            self.assertTrue(fk.__name__ not in sys.modules)
+            self.assertTrue(dirname not in sys.path)
+
+        finally:
+            sys.modules[fk.__name__] = fk
+            sys.path[:] = sys_path
+
+        self.assertEqual(indices.tolist(), [2, 10])
+
+        with fk.worker_pool(1, fk.value_to_index) as pool:
+            self.assertTrue(pool is None)
+
+
+if __name__ == '__main__':
+    util.setup_logging('test_fk_parstack', 'warning')
+    unittest.main()